@@ -31,19 +31,29 @@ class TorchCompressedDevice:
 
     def allocate(self, shape, dtype, comp_config, pin_memory=None, name=None):
         """Allocate a compressed TorchTensor. Round up the shape to group boundary."""
-        assert comp_config.num_bits == 4 and dtype == np.float16
+        assert comp_config.num_bits in (4, 8) and dtype == np.float16
 
         group_size, group_dim = comp_config.group_size, comp_config.group_dim
 
         # Round up
         num_groups = (shape[group_dim] + group_size - 1) // group_size
-        data_shape = (
-            shape[:group_dim] + (num_groups * (group_size // 2),) + shape[group_dim+1:])
-        scale_shape = (
-            shape[:group_dim] + (num_groups, 2) + shape[group_dim+1:])
+        if comp_config.num_bits == 4:
+            data_shape = (
+                shape[:group_dim] + (num_groups * (group_size // 2),) + shape[group_dim+1:])
+            scale_shape = (
+                shape[:group_dim] + (num_groups, 2) + shape[group_dim+1:])
+            data_dtype = np.uint8
+        else:
+            data_shape = (
+                shape[:group_dim] + (num_groups * group_size,) + shape[group_dim+1:])
+            scale_shape = (
+                shape[:group_dim] + (num_groups, 1) + shape[group_dim+1:])
+            data_dtype = np.int8
 
-        data = self.base_device.allocate(data_shape, np.uint8, pin_memory=pin_memory)
-        scale = self.base_device.allocate(scale_shape, np.float16, pin_memory=pin_memory)
+        # int8 keeps fp32 scales, a scale of a small group does not fit in fp16
+        scale_dtype = np.float16 if comp_config.num_bits == 4 else np.float32
+        data = self.base_device.allocate(data_shape, data_dtype, pin_memory=pin_memory)
+        scale = self.base_device.allocate(scale_shape, scale_dtype, pin_memory=pin_memory)
 
         return TorchTensor(shape, np_dtype_to_torch_dtype[dtype],
                            (data, scale, comp_config), self, name=name)
@@ -89,6 +99,8 @@ class TorchCompressedDevice:
         group_size, num_bits, group_dim, symmetric = (
             comp_config.group_size, comp_config.num_bits,
             comp_config.group_dim, comp_config.symmetric)
+        if num_bits == 8:
+            return self.compress_int8(tensor, comp_config)
         assert num_bits == 4 and group_size % 2 == 0 and not symmetric
 
         if tensor.device.type == "cpu" and tensor.dtype == torch.float16:
@@ -143,12 +155,85 @@ class TorchCompressedDevice:
         return TorchTensor(shape, tensor.dtype,
                            (data, scale, comp_config), self)
 
+    def compress_int8(self, tensor, comp_config):
+        """Symmetric group-wise int8 quantization. Round up the shape to group boundary.
+
+        With group_size equal to the size of group_dim, this is per-channel
+        quantization and `data` can be fed to int8 matmuls directly.
+        Dequantize with data * scale, where scale = absmax / 127 in fp32.
+        """
+        group_size, num_bits, group_dim, symmetric = (
+            comp_config.group_size, comp_config.num_bits,
+            comp_config.group_dim, comp_config.symmetric)
+        assert num_bits == 8 and symmetric
+
+        if tensor.device.type == "cpu" and tensor.dtype == torch.float16:
+            tensor = tensor.float()
+
+        shape = tensor.shape
+        num_groups = (shape[group_dim] + group_size - 1) // group_size
+
+        # Pad
+        new_shape = (shape[:group_dim] + (num_groups, group_size) +
+                     shape[group_dim+1:])
+        pad_len = (group_size - shape[group_dim] % group_size) % group_size
+        if pad_len != 0:
+            pad_shape = shape[:group_dim] + (pad_len,) + shape[group_dim+1:]
+            tensor = torch.cat([
+                tensor,
+                torch.zeros(pad_shape, dtype=tensor.dtype, device=tensor.device)],
+                dim=group_dim)
+        data = tensor.view(new_shape)
+
+        # Quantize
+        B = 2 ** (num_bits - 1) - 1
+        absmax = torch.max(data.abs(), dim=group_dim + 1, keepdim=True)[0]
+        scale = absmax.float().div_(B).clamp_(min=torch.finfo(torch.float32).tiny)
+        data = (data / scale).round_().clamp_(-B, B).to(torch.int8)
+
+        # Reshape
+        data_shape = (
+            shape[:group_dim] + (num_groups * group_size,) + shape[group_dim+1:])
+        data = data.view(data_shape)
+
+        data = TorchTensor.create_from_torch(data, self.base_device)
+        scale = TorchTensor.create_from_torch(scale, self.base_device)
+
+        return TorchTensor(shape, tensor.dtype,
+                           (data, scale, comp_config), self)
+
+    def slice_rows(self, tensor, num_rows):
+        """Return a view of the first `num_rows` rows (dim 0) of a compressed tensor."""
+        data, scale, comp_config = tensor.data
+        group_size, num_bits, group_dim = (
+            comp_config.group_size, comp_config.num_bits, comp_config.group_dim)
+
+        if group_dim == 0:
+            scale_rows = (num_rows + group_size - 1) // group_size
+            data_rows = scale_rows * (group_size // 2 if num_bits == 4 else group_size)
+        else:
+            data_rows = scale_rows = num_rows
+
+        data = TorchTensor.create_from_torch(data.data[:data_rows], self.base_device)
+        scale = TorchTensor.create_from_torch(scale.data[:scale_rows], self.base_device)
+        shape = (num_rows,) + tuple(tensor.shape[1:])
+        return TorchTensor(shape, tensor.dtype, (data, scale, comp_config), self)
+
     def decompress(self, tensor):
         data, scale, comp_config = tensor.data
         group_size, num_bits, group_dim, symmetric = (
             comp_config.group_size, comp_config.num_bits,
             comp_config.group_dim, comp_config.symmetric)
 
+        if num_bits == 8:
+            num_groups = data.shape[group_dim] // group_size
+            new_shape = (data.shape[:group_dim] + (num_groups, group_size) +
+                         data.shape[group_dim+1:])
+            data = data.data.view(new_shape).to(tensor.dtype).mul_(scale.data)
+            flatten_shape = data.shape[:group_dim] + (-1,) + data.shape[group_dim+2:]
+            indices = tensor.full_indices
+            return data.reshape(flatten_shape)[indices].contiguous()
+
         group_size_c = group_size // 2
         shape = data.shape
         num_groups = (shape[group_dim] + group_size_c - 1) // group_size_c
@@ -218,7 +303,7 @@ def general_copy_compressed(dst, dst_indices, src, src_indices):
 def get_compressed_indices(tensor, indices, shape):
     comp_config = tensor.data[2]
     group_size, group_dim = comp_config.group_size, comp_config.group_dim
-    assert comp_config.num_bits == 4
+    assert comp_config.num_bits in (4, 8)
 
     if indices is None:
         indices = list(slice(0, x) for x in shape[:group_dim+1])
@@ -227,11 +312,12 @@ def get_compressed_indices(tensor, indices, shape):
     assert indices[group_dim].start % group_size == 0
 
     data_indices = list(indices)
-    data_indices[group_dim] = slice(
-        indices[group_dim].start // 2, (indices[group_dim].stop + 1) // 2)
+    if comp_config.num_bits == 4:
+        data_indices[group_dim] = slice(
+            indices[group_dim].start // 2, (indices[group_dim].stop + 1) // 2)
 
     scale_indices = indices
-    scale_indices.insert(group_dim+1, slice(0, 2))
+    scale_indices.insert(group_dim+1, slice(0, 2 if comp_config.num_bits == 4 else 1))
     scale_indices[group_dim] = slice(
         indices[group_dim].start // group_size,
         (indices[group_dim].stop + group_size - 1) // group_size)
@@ -76,7 +76,7 @@ torch_dtype_to_np_dtype = {
 }
 
 torch_dtype_to_num_bytes = {
-    torch.float16: 2, torch.float32: 4,
+    torch.float16: 2, torch.float32: 4, torch.bfloat16: 2,
     torch.int8: 1, torch.uint8: 1, torch.int32: 4, torch.int64: 8,
     torch.bool: 1,
 }
@@ -70,6 +70,12 @@ class Policy:
     compress_cache: bool
     comp_cache_config: CompressionConfig
 
+    # Quantize MLP weights to per-channel int8 and run the MLP GEMMs in int8
+    int8_mlp_weight: bool = False
+
+    # Store the disk segment of a mixed KV cache in int8, one scale per token and head
+    int8_disk_cache: bool = False
+
     @property
     def w_disk_percent(self):
         return 100 - self.w_gpu_percent - self.w_cpu_percent
@@ -103,14 +109,18 @@ def init_weight_list(weight_specs, policy, env):
     for i in range(len(weight_specs)):
         mid_percent = (sizes_cumsum[i] - sizes[i] / 2) / sizes_cumsum[-1]
         home = get_choice(mid_percent * 100, dev_percents, dev_choices)
-        shape, dtype, filename = weight_specs[i]
+        shape, dtype, filename = weight_specs[i][:3]
 
         if len(shape) < 2:
             pin_memory = True
             compress = False
+        elif len(weight_specs[i]) > 3:
+            # A per-weight compression config overrides the policy
+            pin_memory = policy.pin_weight
+            compress, comp_config = True, weight_specs[i][3]
         else:
             pin_memory = policy.pin_weight
-            compress = policy.compress_weight
+            compress, comp_config = policy.compress_weight, policy.comp_weight_config
 
         if not compress:
             weight = home.allocate(shape, dtype, pin_memory=pin_memory)
@@ -122,7 +132,7 @@ def init_weight_list(weight_specs, policy, env):
                 #weight.load_from_np(np.random.rand(*shape).astype(dtype))
         else:
             weight = home.compressed_device.allocate(
-                shape, dtype, policy.comp_weight_config, pin_memory=pin_memory)
+                shape, dtype, comp_config, pin_memory=pin_memory)
 
             if DUMMY_WEIGHT not in filename:
                 weight.load_from_np_file(weight_specs[i][2])
@@ -514,7 +524,8 @@ class SelfAttention:
             mask, donate[1] = attention_mask.val.smart_copy(self.compute)
             h, new_k_cache, new_v_cache, w_q, w_k, self.partial_index = self.compute.mha(h, mask, w_q, b_q,
                 w_k, b_k, w_v, b_v, w_out, b_out, w_ln, b_ln, n_head, donate,
-                self.policy.compress_cache, self.policy.comp_cache_config, warmup, self.partial_weight_ratio)
+                self.policy.compress_cache, self.policy.comp_cache_config, warmup, self.partial_weight_ratio,
+                no_padding=attention_mask.val.no_padding)
             cache_write_buf.store((new_k_cache, new_v_cache))
             if (prev_partial_cache_read_buf is not None) and (not warmup):
                 prev_partial_cache_read_buf.store(set_partial_cache(new_k_cache.data, self.partial_index, n_head, head_dim))
@@ -551,8 +562,8 @@ class MLP:
         self.layer_id = layer_id
         self.policy = policy
         self.compute = self.env.gpu
-        self.weight_load_dst = (self.compute.compressed_device if policy.compress_weight
-            else self.compute)
+        self.weight_load_dst = (self.compute.compressed_device
+            if policy.compress_weight or policy.int8_mlp_weight else self.compute)
 
         self.task = None
 
@@ -576,6 +587,12 @@ class MLP:
             # b_ln
             ((h,), dtype, path + "final_layer_norm.bias"),
         ]
+        if self.policy.int8_mlp_weight:
+            # One scale per output channel, so the scales factor out of the GEMMs
+            weight_specs[0] += (CompressionConfig(
+                num_bits=8, group_size=h, group_dim=1, symmetric=True),)
+            weight_specs[2] += (CompressionConfig(
+                num_bits=8, group_size=4 * h, group_dim=1, symmetric=True),)
         weights = init_weight_list(weight_specs, self.policy, self.env)
         weight_home.store(weights)
 
@@ -958,7 +975,10 @@ class OptLM:
             else self.env.gpu)
         val = attention_compute.allocate(
             (self.policy.gpu_batch_size, self.task.prompt_len), bool)
-        val.load_from_np((input_ids != self.config.pad_token_id))
+        mask = input_ids != self.config.pad_token_id
+        val.load_from_np(mask)
+        # Checked on the host here, so prefill attention does not sync for it
+        val.no_padding = bool(mask.all())
         self.attention_mask[k].store(val)
 
     def generate(self,
@@ -1019,6 +1039,7 @@ class OptLM:
                 self.init_cache(j, k)
         if self.policy.cpu_cache_compute:
             self.env.cpu.init_attention_compute_workspace(self.config, self.task, self.policy)
+        self.env.gpu.init_decompress_cache(self.policy)
 
         # Generate
         if debug_mode is None:
@@ -1315,6 +1336,10 @@ def get_filename(args):
         filename += "-compw"
     if args.compress_cache:
         filename += "-compc"
+    if args.int8_mlp_weight:
+        filename += "-int8mlp"
+    if args.int8_disk_cache:
+        filename += "-int8diskc"
     return filename
 
 
@@ -1339,7 +1364,7 @@ def run_flexgen(args):
     warmup_inputs = get_inputs(2048, num_prompts, tokenizer, args.warmup_input_path)
     inputs = get_inputs(prompt_len, num_prompts, tokenizer, args.test_input_path)
 
-    gpu = TorchDevice("cuda:0")
+    gpu = TorchDevice("cuda:0", compile_mlp=args.compile_mlp)
     cpu = TorchDevice("cpu")
     disk = TorchDisk(args.offload_dir)
     # 创建了一个执行环境对象env，用于协调不同设备之间的数据处理和计算任务; mixed设备里会在三种设备里自动进行数据调度和计算管理
@@ -1356,8 +1381,12 @@ def run_flexgen(args):
                                       group_dim=0, symmetric=False),
                     args.compress_cache,
                     CompressionConfig(num_bits=4, group_size=64,
-                                      group_dim=2, symmetric=False))
+                                      group_dim=2, symmetric=False),
+                    args.int8_mlp_weight, args.int8_disk_cache)
     assert not (args.compress_cache and args.attn_sparsity < 1.0), "Not implemented"
+    assert not (args.int8_disk_cache and args.attn_sparsity < 1.0), "Not implemented"
+    assert not (args.int8_disk_cache and policy.cache_disk_percent == 100), (
+        "Only the disk segment of a mixed cache is stored in int8")
 
     opt_config = get_opt_config(args.model)
     cache_size = opt_config.cache_bytes(num_prompts, prompt_len + gen_len)
@@ -1434,6 +1463,13 @@ def add_parser_arguments(parser):
         help="Whether to compress weight.")
     parser.add_argument("--compress-cache", action="store_true",
         help="Whether to compress cache.")
+    parser.add_argument("--int8-mlp-weight", action="store_true",
+        help="Whether to quantize MLP weights to int8 and use int8 GEMMs.")
+    parser.add_argument("--int8-disk-cache", action="store_true",
+        help="Whether to store the disk part of the KV cache in int8.")
+    parser.add_argument("--compile-mlp", type=str2bool, nargs="?",
+        const=True, default=True,
+        help="Whether to run the MLP through torch.compile on the GPU.")
 
 
     parser.add_argument("--log-file", type=str, default="auto")
@@ -1,36 +1,54 @@
 """Implement tensor computations with pytorch."""
+from collections import OrderedDict, deque
+import contextlib
+import ctypes
 from enum import Enum, auto
-from functools import partial
+from functools import partial, reduce
 from itertools import count
+import mmap
+import operator
 import os
-import queue
-import shutil
 import time
 import threading
 from typing import Optional, Union, Tuple
+import warnings
+import weakref
 
 import torch
 import torch.nn.functional as F
 import numpy as np
 
-from flexgen.utils import (GB, T, cpu_mem_stats, vector_gather,
+from flexgen.utils import (GB, MB, T, cpu_mem_stats, vector_gather,
     np_dtype_to_torch_dtype, torch_dtype_to_np_dtype,
     torch_dtype_to_num_bytes)
 
-from infinigen.skewing_controller import reform_hidden_states, skew
+from infinigen.skewing_controller import (reform_hidden_states, skew,
+    weight_bias_concat)
 from infinigen.partial_weight_generation_controller import partial_weight_index_generation
 from infinigen.kv_selection_controller import speculate_attention
 
 general_copy_compressed = TorchCompressedDevice = None
+CompressionConfig = get_compressed_indices = None
 global_cpu_device = None
 global_disk_device = None
+# A cpu device created by the calling thread takes precedence over the
+# global, so threads can work with their own cpu device
+_thread_devices = threading.local()
+
+
+def get_cpu_device():
+    """Return the cpu TorchDevice of the calling thread, or the last one created."""
+    return getattr(_thread_devices, "cpu_device", None) or global_cpu_device
 
 
 def fix_recursive_import():
-    global general_copy_compressed, TorchCompressedDevice, global_cpu_device
+    global general_copy_compressed, TorchCompressedDevice
+    global CompressionConfig, get_compressed_indices
     from flexgen import compression
     general_copy_compressed = compression.general_copy_compressed
     TorchCompressedDevice = compression.TorchCompressedDevice
+    CompressionConfig = compression.CompressionConfig
+    get_compressed_indices = compression.get_compressed_indices
 
 
 class DeviceType(Enum):
@@ -69,7 +87,7 @@ class TorchTensor:  # 这是个包装了pytorch tensor的类，实现了不同
     Note:
     For a tensor on a TorchDevice, self.data is a primitive tensor.
       type: torch.Tensor.
-    For a tensor on a TorchDisk, self.data is a filename.
+    For a tensor on a TorchDisk, self.data is a filename of the raw data.
       type: str
     For a tensor on a TorchMixedDevice, self.data is (tensors, segment_points)
       type: Tuple[Tuple[TorchTensor], Tuple[int]]
@@ -91,10 +109,20 @@ class TorchTensor:  # 这是个包装了pytorch tensor的类，实现了不同
         self.delete_file = True
 
         self.name = name or TorchTensor.next_name()
+        self._full_indices = None
+
+    @property
+    def full_indices(self):
+        """Indices selecting the whole tensor, e.g. for copies without indices."""
+        # Rebuilt if `shape` is reassigned, as flex_opt does for w_q/w_k
+        if self._full_indices is None or self._full_indices[0] is not self.shape:
+            self._full_indices = (self.shape, tuple(slice(0, x) for x in self.shape))
+        return self._full_indices[1]
 
     @property
     def bytes(self):
-        return np.prod(self.shape) * torch_dtype_to_num_bytes[self.dtype]
+        # Not cached: flex_opt reassigns `shape` of the fused w_q/w_k weights
+        return reduce(operator.mul, self.shape, 1) * torch_dtype_to_num_bytes[self.dtype]
 
     @classmethod
     def next_name(cls):  # 用于给每个tensor分配id
@@ -106,25 +134,33 @@ class TorchTensor:  # 这是个包装了pytorch tensor的类，实现了不同
 
     def delete(self):
         assert self.device is not None, "already deleted"
-        if self.device.device_type == DeviceType.DISK:
+        if self.device.device_type in (DeviceType.DISK, DeviceType.MIXED):
             self.device.delete(self)
+        elif (self.device.device_type == DeviceType.COMPRESSED and
+              self.device.base_device.device_type == DeviceType.DISK):
+            self.data[0].delete()
+            self.data[1].delete()
         self.device = self.data = None  # 非disk张量直接清空即可, python会自动gc (无论cpu还是gpu，但不一定立即执行)
 
     def load_from_np(self, np_array):  # 从np.array数组中创建该类
         if self.device.device_type == DeviceType.DISK:
-            with open(self.data, "wb") as fout:
-                np.save(fout, np_array)
+            np_array = np.ascontiguousarray(
+                np_array, dtype=torch_dtype_to_np_dtype[self.dtype])
+            # Overwrite in place, truncating would invalidate cached mappings
+            with open(self.data, "r+b", buffering=0) as fout:
+                fout.write(np_array.data)
         else:
             if self.device.device_type == DeviceType.COMPRESSED:
                 tmp = torch.from_numpy(np_array)
-                tmp = global_cpu_device.compressed_device.compress(tmp, self.data[2])
+                tmp = get_cpu_device().compressed_device.compress(tmp, self.data[2])
                 general_copy(self, None, tmp, None)
             else:
                 self.data.copy_(torch.from_numpy(np_array))  # torch.Tensor.copy_(默认non_blocking=False)是pytorch里的常用操作，就是对张量进行就地更新，可以跨cpu/gpu，形状必须相同
 
     def load_from_np_file(self, filename):
         if self.device.device_type == DeviceType.DISK:
-            shutil.copy(filename, self.data)
+            # Strip the .npy header, disk tensors store raw data
+            self.load_from_np(np.load(filename, mmap_mode="r"))
         else:
             self.load_from_np(np.load(filename))
 
@@ -160,10 +196,123 @@ class TorchTensor:  # 这是个包装了pytorch tensor的类，实现了不同
                 f"device={self.device.name if self.device else None})")
 
 
+# Only allocations at least this large are pinned in place, e.g. kv caches
+PIN_INPLACE_MIN_BYTES = 64 * MB
+
+
+def empty_pinned(shape, dtype):
+    """Return an uninitialized pinned cpu tensor.
+
+    The caching host allocator behind pin_memory=True rounds the size up to a
+    power of two, which wastes up to half of a large allocation. Large tensors
+    are instead placed in a page-aligned buffer of their own and page-locked
+    in place with cudaHostRegister, so no pages are shared with other tensors
+    and only the page padding is wasted. The memory is unregistered when the
+    buffer is freed. Small tensors, or a failed registration, fall back to
+    pin_memory=True.
+    """
+    numel = reduce(operator.mul, shape, 1)
+    nbytes = numel * torch_dtype_to_num_bytes[dtype]
+    if nbytes < PIN_INPLACE_MIN_BYTES:
+        return torch.empty(shape, dtype=dtype, pin_memory=True)
+
+    page = mmap.PAGESIZE
+    padded = (nbytes + page - 1) // page * page
+    # The numpy array owns the memory and lives as long as any tensor view,
+    # so its finalizer unregisters the pages right before they are freed
+    raw = np.empty((padded + page,), dtype=np.uint8)
+    start = -raw.ctypes.data % page
+    buf = torch.from_numpy(raw[start:start + padded])
+    cudart = torch.cuda.cudart()
+    ptr = buf.data_ptr()
+    if cudart.cudaHostRegister(ptr, padded, 0) != cudart.cudaError.success:
+        cuda_clear_last_error()
+        return torch.empty(shape, dtype=dtype, pin_memory=True)
+    weakref.finalize(raw, cudart.cudaHostUnregister, ptr)
+    return buf[:nbytes].view(dtype).view(shape)
+
+
+def cuda_clear_last_error():
+    """Reset the last error of the CUDA runtime after a failed call, so a
+    later unrelated error check does not report it.
+
+    torch.cuda.cudart() does not bind cudaGetLastError. The runtime is
+    loaded with global symbols (through libtorch_global_deps), so look it
+    up there.
+    """
+    try:
+        ctypes.CDLL(None).cudaGetLastError()
+    except (AttributeError, OSError):
+        pass
+
+
+def sdpa_supports_scale():
+    """Whether F.scaled_dot_product_attention exists and takes `scale`.
+
+    The attention paths pass scale=1.0 because the scaling is folded into
+    w_q. The keyword was added in torch 2.1, torch 2.0 raises TypeError.
+    """
+    if not hasattr(F, "scaled_dot_product_attention"):
+        return False
+    x = torch.zeros(1, 1, 1)
+    try:
+        F.scaled_dot_product_attention(x, x, x, scale=1.0)
+    except TypeError:
+        return False
+    return True
+
+
+def cpu_attention_dtype():
+    """Dtype of the CPU attention workspace.
+
+    CPU attention is memory-bound, so BF16 halves its cost on CPUs with
+    native BF16 kernels (AVX512-BF16/AMX via oneDNN). Other CPUs use FP32.
+    """
+    try:
+        if torch.ops.mkldnn._is_mkldnn_bf16_supported():
+            return torch.bfloat16
+    except (AttributeError, RuntimeError):
+        pass
+    return torch.float32
+
+
+def mlp_body(inputs, wi, bi, wo, bo, w_ln, b_ln):
+    """LayerNorm -> fc1 -> ReLU -> fc2 -> residual on (tokens, h) inputs."""
+    out = F.layer_norm(inputs, (inputs.shape[-1],), weight=w_ln, bias=b_ln)
+    out = F.linear(out, wi, bias=bi).relu_()
+    # residual + out @ wo.T in one GEMM
+    return torch.addmm(inputs, out, wo.t()).add_(bo)
+
+
+def int8_mm_supported(inputs, n):
+    """Whether torch._int_mm can multiply the (m, k) `inputs` by a (k, n) weight.
+
+    It needs CUDA, more than 16 rows and 8-aligned k and n, and is missing
+    before torch 2.1.
+    """
+    m, k = inputs.shape
+    return (hasattr(torch, "_int_mm") and inputs.is_cuda and
+            m > 16 and k % 8 == 0 and n % 8 == 0)
+
+
+def int8_linear(inputs, weight, scale, bias):
+    """F.linear with a per-output-channel int8 weight (dequant: weight * scale).
+
+    Activations are quantized per token on the fly and the GEMM runs in
+    torch._int_mm. Check int8_mm_supported first.
+    """
+    n = weight.shape[0]
+    x_scale = inputs.abs().amax(dim=-1, keepdim=True).float().clamp_(min=1e-8) / 127
+    x_int8 = (inputs.float() / x_scale).round_().clamp_(-127, 127).to(torch.int8)
+    out = torch._int_mm(x_int8, weight.t()).float()
+    out = out.mul_(x_scale).mul_(scale.view(1, n).float())
+    return out.to(inputs.dtype).add_(bias)
+
+
 class TorchDevice:
     """Wrap tensor and computation APIs of a single CPU or GPU."""
 
-    def __init__(self, name, mem_capacity=None, flops=None):
+    def __init__(self, name, mem_capacity=None, flops=None, compile_mlp=True):
         self.name = name
         self.mem_capacity = mem_capacity
         self.flops = flops
@@ -176,10 +325,38 @@ class TorchDevice:
 
         self.attention_compute_workspace = None
         self.workspace_pt = 0
+        self.attention_compute_dtype = cpu_attention_dtype()
+
+        # Fused attention kernels (FlashAttention/memory-efficient) when available
+        self._use_sdpa = sdpa_supports_scale()
+
+        # Causal biases of recent prompt lengths, in LRU order
+        self._causal_bias_cache = OrderedDict()
+        self._causal_bias_cache_size = 4
+
+        # Decompressed weights kept for the next gpu batch, in LRU order.
+        # Disabled until init_decompress_cache enables it.
+        self._decompress_cache = OrderedDict()
+        self._decompress_cache_max_bytes = 0
+        self._decompress_cache_bytes = 0
+
+        # Let inductor fuse the layer norm, bias, relu and residual epilogues
+        # of the mlp on GPUs. Inputs are flattened to (b * s, h), so prefill and
+        # decoding share one dynamic graph unless b * s == 1.
+        # Cleared if the compile fails, so it is not retried on every call.
+        self.compile_mlp = (compile_mlp and self.device_type == DeviceType.CUDA
+                            and hasattr(torch, "compile"))
+        self.mlp_body = (torch.compile(mlp_body, dynamic=True)
+                         if self.compile_mlp else mlp_body)
+
+        # Pinned staging buffers and copy stream for mixed device attention
+        self._mixed_copy_stream = None
+        self._pinned_bufs = {}
 
         if self.device_type == DeviceType.CPU:  # cpu设备用全局变量指示
             global global_cpu_device
             global_cpu_device = self
+            _thread_devices.cpu_device = self
 
     def add_link(self, link):
         dst = link.b if link.a == self else link.a
@@ -191,7 +368,10 @@ class TorchDevice:
         else:
             pin_memory = False
         dtype = np_dtype_to_torch_dtype[dtype]
-        data = torch.empty(shape, dtype=dtype, pin_memory=pin_memory, device=self.dev)  # 创建未初始化的torch.Tensor
+        if pin_memory and torch.cuda.is_available():
+            data = empty_pinned(shape, dtype)
+        else:
+            data = torch.empty(shape, dtype=dtype, pin_memory=pin_memory, device=self.dev)  # 创建未初始化的torch.Tensor
         return TorchTensor.create_from_torch(data, self, name=name) # 用TorchTensor包装
 
     def delete(self, tensor):
@@ -199,7 +379,7 @@ class TorchDevice:
 
     def init_attention_compute_workspace(self, config, task, policy):
         if self.device_type != DeviceType.CPU:
-            return  # Only CPU requires this fp32 workspace
+            return  # Only CPU requires this fp32/bf16 workspace
 
         if not policy.compress_cache:
             b = policy.gpu_batch_size
@@ -213,13 +393,24 @@ class TorchDevice:
             # so we only need one workspace instead of two.
             for i in range(1 if policy.sep_layer else 2):
                 shape = (max_seq_len, b * n_head, head_dim)
-                k_cache = self.allocate(shape, np.float32, pin_memory=False)
-                v_cache = self.allocate(shape, np.float32, pin_memory=False)
+                dtype = self.attention_compute_dtype
+                k_cache = TorchTensor.create_from_torch(
+                    torch.empty(shape, dtype=dtype), self)
+                v_cache = TorchTensor.create_from_torch(
+                    torch.empty(shape, dtype=dtype), self)
                 self.attention_compute_workspace.append((k_cache, v_cache))
         else:
             self.compressed_device.init_attention_compute_workspace(
                 config, task, policy)
 
+    def init_decompress_cache(self, policy, max_bytes=2 * GB):
+        """Keep up to `max_bytes` of decompressed weights for the next gpu
+        batch. Only useful with several gpu batches per layer."""
+        self._decompress_cache.clear()
+        self._decompress_cache_bytes = 0
+        self._decompress_cache_max_bytes = (
+            max_bytes if policy.num_gpu_batches > 1 else 0)
+
     def next_attention_compute_workspace(self):
         self.workspace_pt = (self.workspace_pt + 1) % len(
             self.attention_compute_workspace)
@@ -257,14 +448,18 @@ class TorchDevice:
         token_embed = F.embedding(token_ids, w_token.data, pad_token_id)
 
         # pos embedding
-        # cumsum是累加的意思, 因此这一行的效果是为每个有效token分配了一个顺序下标, 即1,2,3,4,...
-        positions = torch.cumsum(mask, dim=1).int() * mask + 1
-
-        # cut positions if `past_key_values_length` is > 0
-        # 对于过去的kv cache的长度，这一部分position直接截断, 比如decodo阶段，token_ids只有一个, 对应的position也只需要1个
-        # TODO: 这里是不是可以使用循环位置编码?
         past_key_values_length = mask.shape[1] - token_ids.shape[1]
-        positions = positions[:, past_key_values_length:]
+        if token_ids.shape[1] == 1:
+            # Decoding: the position of the only new token is the number of
+            # valid tokens, no need for a prefix sum over the whole mask
+            positions = mask.sum(dim=1, keepdim=True) * mask[:, -1:] + 1
+        else:
+            # cumsum是累加的意思, 因此这一行的效果是为每个有效token分配了一个顺序下标, 即1,2,3,4,...
+            positions = torch.cumsum(mask, dim=1).int() * mask + 1
+
+            # cut positions if `past_key_values_length` is > 0
+            # 对于过去的kv cache的长度，这一部分position直接截断, 比如decodo阶段，token_ids只有一个, 对应的position也只需要1个
+            positions = positions[:, past_key_values_length:]
 
         pos_embed = F.embedding(positions, w_pos.data)
 
@@ -298,17 +493,27 @@ class TorchDevice:
             config.n_head, config.input_dim, task.prompt_len, task.gen_len,
             policy.gpu_batch_size)
         shape = (prompt_len + gen_len - 1, gpu_batch_size * num_head, hidden_size // num_head)  # KV cache的形状
-        # NOTE: disable pin_memory due to high memory overhead
-        pin_memory = False
-        k_cache = self.allocate(shape, np.float16, pin_memory=pin_memory)  # 直接allocate对应形状的未初始化的张量即可
-        v_cache = self.allocate(shape, np.float16, pin_memory=pin_memory)
+        # Pin a cpu cache that is copied to the gpu every step, so the copies
+        # are asynchronous DMA transfers without a relay buffer
+        pin_memory = (self.device_type == DeviceType.CPU and
+                      not policy.cpu_cache_compute)
+        # K and V share one allocation, so a pinned cache is registered once
+        kv_cache = self.allocate((2,) + shape, np.float16, pin_memory=pin_memory)  # 直接allocate对应形状的未初始化的张量即可
+        k_cache = TorchTensor.create_from_torch(kv_cache.data[0], self)
+        v_cache = TorchTensor.create_from_torch(kv_cache.data[1], self)
         return k_cache, v_cache
 
     def mha(self, inputs, attention_mask, w_q, b_q, w_k, b_k, w_v, b_v,
-            w_out, b_out, w_ln, b_ln, n_head, donate, compress_cache, comp_config, warmup=False, partial_weight_ratio=0.1):  # TODO: 细读attention
-        """Multi-head attention (prefill phase)."""
+            w_out, b_out, w_ln, b_ln, n_head, donate, compress_cache, comp_config, warmup=False, partial_weight_ratio=0.1,
+            no_padding=False):  # TODO: 细读attention
+        """Multi-head attention (prefill phase).
+
+        `no_padding` tells that the attention mask is all ones, so the fused
+        kernel can apply the causal mask itself.
+        """
         # decompress weights
-        if w_q.device.device_type == DeviceType.COMPRESSED:
+        compressed = w_q.device.device_type == DeviceType.COMPRESSED
+        if compressed:
             w_q = w_q.device.decompress(w_q)
             w_k = w_k.device.decompress(w_k)
             w_v = w_v.device.decompress(w_v)
@@ -316,15 +521,13 @@ class TorchDevice:
 
         b, s, h = inputs.shape
         head_dim = h // n_head
-        scaling = head_dim ** -0.5
 
         hidden = F.layer_norm(inputs.data, (h,), weight=w_ln.data, bias=b_ln.data)
         new_h = reform_hidden_states(hidden)
 
         # shape: (b, s, h)
-        q = F.linear(new_h, w_q.data, bias=None)
-        k = F.linear(new_h, w_k.data, bias=None)
-        v = F.linear(hidden, w_v.data, bias=b_v.data)
+        q, k, v = self._qkv_projection(hidden, new_h, w_q, w_k, w_v, b_v,
+            reuse=not (compressed or donate[2] or donate[4] or donate[6]))
 
         # Partial weight index generation
         partial_weight_index = None
@@ -339,41 +542,59 @@ class TorchDevice:
         if warmup:
             w_q.data, w_k.data = skew(q, k, w_q.data, w_k.data, n_head, head_dim)
 
-        # shape: (b * n_head, s, head_dim)
-        q = q.permute(0, 2, 1, 3).reshape(b * n_head, s, head_dim)
-        # shape: (b * n_head, head_dim, s)
-        k = k.permute(0, 2, 3, 1).reshape(b * n_head, head_dim, s)
-        # shape: (b * n_head, s, head_dim)
-        v = v.permute(0, 2, 1, 3).reshape(b * n_head, s, head_dim)
-
-        # shape: (b * n_head, s, s)
-        attn_weights = torch.bmm(q, k)
-
-        # shape: (b, 1, s, s)
-        idx = torch.arange(s, device=self.dev)
-        causal_mask = (idx <= idx.view(s, 1)).view(1, 1, s, s)
-        mask = attention_mask.data.view(b, 1, 1, s) & causal_mask
-
-        # shape: (b, n_head, s, s)
-        attn_weights = attn_weights.view(b, n_head, s, s)
-        attn_weights = torch.where(mask, attn_weights, -1e4)
-        attn_weights = attn_weights.view(b * n_head, s, s)
-        attn_weights = F.softmax(attn_weights, dim=2)
-        # shape: (b, n_head, s, head_dim)
-        value = torch.bmm(attn_weights, v).view(b, n_head, s, head_dim)
-        # shape: (b, s, h)
-        value = value.transpose(1, 2).reshape(b, s, h)
-        value = F.linear(value, w_out.data, bias=b_out.data)
-
-        value.add_(inputs.data)
+        if self._use_sdpa:
+            # The 1/sqrt(head_dim) scaling is folded into w_q (see weight_bias_concat).
+            # Without padding the kernel applies the causal mask itself and
+            # never materializes the attention weights.
+            if no_padding:
+                attn_mask, is_causal = None, True
+            else:
+                # shape: (b, 1, s, s)
+                attn_mask = (self._get_causal_bias(s, q.dtype) +
+                             self._padding_bias(attention_mask.data, q.dtype))
+                is_causal = False
+            # shape: (b, n_head, s, head_dim)
+            value = F.scaled_dot_product_attention(
+                q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2),
+                attn_mask=attn_mask, is_causal=is_causal, scale=1.0)
+            # shape: (b, s, h)
+            value = value.transpose(1, 2).reshape(b * s, h)
+
+            # (s, b * n_head, head_dim)
+            k = k.transpose(0, 1).reshape(s, b * n_head, head_dim)
+            v = v.transpose(0, 1).reshape(s, b * n_head, head_dim)
+        else:
+            # shape: (b * n_head, s, head_dim)
+            q = q.permute(0, 2, 1, 3).reshape(b * n_head, s, head_dim)
+            # shape: (b * n_head, head_dim, s)
+            k = k.permute(0, 2, 3, 1).reshape(b * n_head, head_dim, s)
+            # shape: (b * n_head, s, head_dim)
+            v = v.permute(0, 2, 1, 3).reshape(b * n_head, s, head_dim)
+
+            # The 1/sqrt(head_dim) scaling is folded into w_q (see weight_bias_concat),
+            # so the causal bias is the only epilogue of the QK^T matmul.
+            # shape: (b * n_head, s, s)
+            attn_weights = torch.baddbmm(
+                self._get_causal_bias(s, q.dtype).view(1, s, s), q, k)
+
+            # shape: (b, n_head, s, s)
+            attn_weights.view(b, n_head, s, s).add_(
+                self._padding_bias(attention_mask.data, attn_weights.dtype))
+            attn_weights = F.softmax(attn_weights, dim=2)
+            # shape: (b, n_head, s, head_dim)
+            value = torch.bmm(attn_weights, v).view(b, n_head, s, head_dim)
+            # shape: (b, s, h)
+            value = value.transpose(1, 2).reshape(b * s, h)
+
+            # (s, b * n_head, head_dim)
+            k = k.permute(2, 0, 1)
+            v = v.permute(1, 0, 2)
+
+        value = self._out_proj_residual(value, w_out, b_out, inputs, donate[0])
 
         if donate[0]: inputs.delete()
         if donate[1]: attention_mask.delete()
 
-        # (s, b * n_head, head_dim)
-        k = k.permute(2, 0, 1)
-        v = v.permute(1, 0, 2)
-
         if compress_cache:
             k = self.compressed_device.compress(k, comp_config)
             v = self.compressed_device.compress(v, comp_config)
@@ -388,16 +609,19 @@ class TorchDevice:
                 attn_sparsity, compress_cache, comp_config, p_w_q, partial_k_cache, speculation_stream, alpha, max_num_kv):
         """Multi-head attention (decoding phase)."""
         # decompress weights
-        if w_q.device.device_type == DeviceType.COMPRESSED:
-            w_q = w_q.device.decompress(w_q)
-            w_k = w_k.device.decompress(w_k)
-            w_v = w_v.device.decompress(w_v)
-            w_out = w_out.device.decompress(w_out)
+        compressed = w_q.device.device_type == DeviceType.COMPRESSED
+        if compressed:
+            w_q = self._cached_decompress(w_q, donate[2])
+            w_k = self._cached_decompress(w_k, donate[4])
+            w_v = self._cached_decompress(w_v, donate[6])
+            w_out = self._cached_decompress(w_out, donate[8])
 
         b, tgt_s, h = inputs.shape
-        src_s = min(attention_mask.shape[1], k_cache.shape[0] + 1)
+        if isinstance(k_cache, TorchTensor):
+            src_s = min(attention_mask.shape[1], k_cache.shape[0] + 1)
+        else:  # (gpu part, cpu part) of a mixed device cache
+            src_s = attention_mask.shape[1]
         head_dim = h // n_head
-        scaling = head_dim ** -0.5
 
         hidden = F.layer_norm(inputs.data, (h,), weight=w_ln.data, bias=b_ln.data)
         new_h = reform_hidden_states(hidden)
@@ -408,9 +632,8 @@ class TorchDevice:
                 prefetch_idx = speculate_attention(new_h, p_w_q, partial_k_cache, n_head, alpha, max_num_kv)
 
         # shape: (b, 1, h)
-        q = F.linear(new_h, w_q.data, bias=None)
-        k = F.linear(new_h, w_k.data, bias=None)
-        v = F.linear(hidden, w_v.data, bias=b_v.data)
+        q, k, v = self._qkv_projection(hidden, new_h, w_q, w_k, w_v, b_v,
+            reuse=not (compressed or donate[2] or donate[4] or donate[6]))
         # shape: (b, 1, n_head, head_dim)
         q = q.view(b, tgt_s, n_head, head_dim)
         k = k.view(b, tgt_s, n_head, head_dim)
@@ -425,16 +648,32 @@ class TorchDevice:
 
         if isinstance(k_cache, TorchTensor):
             if attn_sparsity >= 1.0:  # Dense attention
-                if compress_cache:
+                if compress_cache and k_cache.shape[0] >= src_s:
+                    # Only decompress the rows in use. The cache may be the whole
+                    # preallocated home tensor. The new token is written in place.
                     # shape: (s, b * n_head, head_dim)
-                    k = k_cache.device.decompress(k_cache)[:src_s]
-                    v = v_cache.device.decompress(v_cache)[:src_s]
+                    k = k_cache.device.decompress(k_cache.device.slice_rows(k_cache, src_s))
+                    v = v_cache.device.decompress(v_cache.device.slice_rows(v_cache, src_s))
+                    k[src_s-1:src_s] = k_new
+                    v[src_s-1:src_s] = v_new
+                elif compress_cache:
+                    # shape: (s, b * n_head, head_dim)
+                    k = k_cache.device.decompress(k_cache)[:src_s-1]
+                    v = v_cache.device.decompress(v_cache)[:src_s-1]
+                    k = torch.cat((k, k_new), dim=0)
+                    v = torch.cat((v, v_new), dim=0)
+                elif k_cache.shape[0] >= src_s:
+                    # The cache buffer has room for the new token, write it in place
+                    k_cache.data[src_s-1:src_s] = k_new
+                    v_cache.data[src_s-1:src_s] = v_new
+                    # shape: (s, b * n_head, head_dim)
+                    k = k_cache.data[:src_s]
+                    v = v_cache.data[:src_s]
                 else:
+                    # e.g. the prefetched kv holds exactly the selected tokens
                     # shape: (s, b * n_head, head_dim)
-                    k = k_cache.data[:src_s-1]
-                    v = v_cache.data[:src_s-1]
-                k  = torch.cat((k, k_new), dim = 0)
-                v  = torch.cat((v, v_new), dim = 0)
+                    k = torch.cat((k_cache.data[:src_s-1], k_new), dim=0)
+                    v = torch.cat((v_cache.data[:src_s-1], v_new), dim=0)
 
                 # shape: (b * n_head, head_dim, s)
                 k = k.permute(1, 2, 0).reshape(b * n_head, head_dim, -1)
@@ -445,8 +684,9 @@ class TorchDevice:
                     value = self._attention_value(q, k, v, None,
                         b, src_s, tgt_s, n_head, head_dim)
                 else:
-                    q = q.float().cpu()
-                    k, v = k.float(), v.float()
+                    dtype = self.attention_compute_dtype
+                    q = q.to(dtype).cpu()
+                    k, v = k.to(dtype), v.to(dtype)
                     value = self._attention_value(q, k, v, None,
                         b, src_s, tgt_s, n_head, head_dim).cuda().half()
             else:  # Sparse attention
@@ -461,7 +701,7 @@ class TorchDevice:
                         attention_mask.data, b, src_s, tgt_s, n_head, head_dim,
                         attn_sparsity)
                 else:
-                    q = q.float().cpu()
+                    q = q.to(k.dtype).cpu()
                     value = self._sparse_attention_value(q, k, v_new, v_cache,
                         attention_mask.data, b, src_s, tgt_s, n_head, head_dim,
                         attn_sparsity).cuda().half()
@@ -472,10 +712,8 @@ class TorchDevice:
                 n_head, head_dim)
 
         # shape: (b, 1, h)
-        value = value.transpose(1, 2).view(b, tgt_s, h)
-        value = F.linear(value, w_out.data, bias=b_out.data)
-
-        value.add_(inputs.data)
+        value = value.transpose(1, 2).reshape(b * tgt_s, h)
+        value = self._out_proj_residual(value, w_out, b_out, inputs, donate[0])
 
         if donate[0]: inputs.delete()
         if donate[1]: attention_mask.delete()
@@ -493,21 +731,116 @@ class TorchDevice:
 
         return TorchTensor.create_from_torch(value, self), k_new, v_new, prefetch_idx
 
+    def _out_proj_residual(self, value, w_out, b_out, inputs, donated):
+        """Return inputs + value @ w_out.T + b_out with shape of inputs.
+
+        The residual is accumulated by the GEMM itself (beta=1), so the
+        projection output is never added in a separate pass. A donated input
+        is used as the output buffer.
+        """
+        residual = inputs.data.view(value.shape)
+        if donated:
+            out = residual.addmm_(value, w_out.data.t())
+        else:
+            out = torch.addmm(residual, value, w_out.data.t())
+        return out.add_(b_out.data).view(inputs.shape)
+
+    def _cached_decompress(self, w, donated):
+        """Decompress a weight, reusing the result from the previous gpu batch.
+
+        Entries hold a reference to the compressed tensor, so its id is not
+        reused while cached. A donated weight is used for the last time and
+        its entry is dropped.
+        """
+        if w.device.base_device.device_type == DeviceType.CPU:
+            # Decompressed into a shared ring workspace, cannot be kept
+            return w.device.decompress(w)
+
+        entry = self._decompress_cache.pop(id(w), None)
+        if entry is not None:
+            data = entry[1]
+            self._decompress_cache_bytes -= data.numel() * data.element_size()
+        else:
+            data = w.device.decompress(w)
+        nbytes = data.numel() * data.element_size()
+        if not donated and nbytes <= self._decompress_cache_max_bytes:
+            self._decompress_cache[id(w)] = (w, data)
+            self._decompress_cache_bytes += nbytes
+            while self._decompress_cache_bytes > self._decompress_cache_max_bytes:
+                _, (_, old) = self._decompress_cache.popitem(last=False)
+                self._decompress_cache_bytes -= old.numel() * old.element_size()
+        return data
+
+    def _qkv_projection(self, hidden, new_h, w_q, w_k, w_v, b_v, reuse):
+        """Compute q, k, v with a single GEMM when the weights are reused.
+
+        w_q and w_k already carry their bias as an extra input column and are
+        applied to `new_h` (hidden with a column of 1). Concatenating b_v to w_v
+        the same way lets the three projections share one matmul. The fused
+        weight is built once and cached on w_q; w_q, w_k and w_v are rebound
+        to views of it so the attention weights are not held twice. In-place
+        updates such as `skew` during warmup write through the views.
+        """
+        h = w_k.shape[0]
+        fused = getattr(w_q, "_qkv_fused", None)
+        if fused is not None and not (fused[1] is w_q.data and
+                fused[2] is w_k.data and fused[3] is w_v.data):
+            fused = None
+
+        if fused is None and reuse:
+            w_qkv = torch.cat((w_q.data, w_k.data,
+                weight_bias_concat(w_v.data, b_v.data)), dim=0)
+            w_q.data, w_k.data, w_v.data = w_qkv[:h], w_qkv[h:2*h], w_qkv[2*h:, :h]
+            fused = w_q._qkv_fused = (w_qkv, w_q.data, w_k.data, w_v.data)
+
+        if fused is None:
+            q = F.linear(new_h, w_q.data, bias=None)
+            k = F.linear(new_h, w_k.data, bias=None)
+            v = F.linear(hidden, w_v.data, bias=b_v.data)
+            return q, k, v
+        return F.linear(new_h, fused[0], bias=None).split(h, dim=-1)
+
+    def _get_causal_bias(self, s, dtype):
+        """Return a (1, 1, s, s) bias that is -1e4 above the diagonal and 0 elsewhere."""
+        key = (s, dtype)
+        bias = self._causal_bias_cache.pop(key, None)
+        if bias is None:
+            bias = torch.full((s, s), -1e4, dtype=dtype, device=self.dev)
+            bias = torch.triu(bias, diagonal=1).view(1, 1, s, s)
+        self._causal_bias_cache[key] = bias
+        if len(self._causal_bias_cache) > self._causal_bias_cache_size:
+            self._causal_bias_cache.popitem(last=False)
+        return bias
+
+    def _padding_bias(self, mask, dtype):
+        """Turn a (b, s) bool attention mask into a (b, 1, 1, s) additive bias."""
+        b, s = mask.shape
+        return (~mask).view(b, 1, 1, s).to(dtype) * -1e4
+
     def _attention_weights(self, q, k, mask, b, src_s, n_head):
-        # shape: (b * n_head, 1, s)
-        attn_weights = torch.bmm(q, k)
-        # shape: (b, 1, 1, s)
-        if mask is not None:
-            mask = mask.view(b, 1, 1, src_s)
-        # shape: (b * n_head, 1, s)
-        attn_weights = attn_weights.view(b, n_head, 1, src_s)
-        if mask is not None:
-            attn_weights = torch.where(mask, attn_weights, -1e4)
-        attn_weights = attn_weights.view(b * n_head, 1, src_s)
+        if mask is None:
+            # shape: (b * n_head, 1, s)
+            attn_weights = torch.bmm(q, k)
+        else:
+            # shape: (b * n_head, 1, s)
+            bias = self._padding_bias(mask.view(b, src_s), q.dtype)
+            bias = bias.expand(b, n_head, 1, src_s).reshape(b * n_head, 1, src_s)
+            attn_weights = torch.baddbmm(bias, q, k)
         attn_weights = F.softmax(attn_weights, dim=2)
         return attn_weights
 
     def _attention_value(self, q, k, v, mask, b, src_s, tgt_s, n_head, head_dim):
+        if self._use_sdpa:
+            attn_mask = None
+            if mask is not None:
+                # shape: (b * n_head, 1, s)
+                attn_mask = self._padding_bias(mask.view(b, src_s), q.dtype)
+                attn_mask = attn_mask.expand(b, n_head, 1, src_s).reshape(
+                    b * n_head, 1, src_s)
+            # shape: (b, n_head, 1, head_dim)
+            return F.scaled_dot_product_attention(q, k.transpose(1, 2), v,
+                attn_mask=attn_mask, scale=1.0).view(b, n_head, tgt_s, head_dim)
+
         # shape: (b * n_head, 1, s)
         attn_weights = self._attention_weights(q, k, mask, b, src_s, n_head)
         # shape: (b, n_head, 1, head_dim)
@@ -525,28 +858,42 @@ class TorchDevice:
         attn_weights = torch.cat([topk_weights,
             attn_weights[:, :, -1].unsqueeze(-1)], dim=-1)
 
-        if k.is_cuda:
-            v_home = v_cache
-            v_buf = self.allocate((topk+1, b*n_head, head_dim), np.float16)
-            topk_indices = topk_indices.cpu()
+        if k.is_cuda and v_cache.device.device_type == DeviceType.CUDA:
+            # The value cache is on the same gpu, gather without leaving the device
+            # shape: (topk+1, b * n_head, head_dim)
+            v = torch.cat((vector_gather(v_cache.data, topk_indices), v_new), dim=0)
         else:
-            (v_home, v_buf) = v_cache
+            if k.is_cuda:
+                v_home = v_cache
+                v_buf = self.allocate((topk+1, b*n_head, head_dim), np.float16)
+                topk_indices = topk_indices.cpu()
+            else:
+                (v_home, v_buf) = v_cache
 
-        # shape: (s, b * n_head, head_dim)
-        indices_src = topk_indices
-        indices_tgt = (slice(0, indices_src.shape[0]), slice(0, v_home.shape[1]))
-        general_copy(v_buf, indices_tgt, v_home, indices_src)
-        v_home.device.synchronize()
-
-        # shape: (topk+1, b * n_head, head_dim)
-        v = v_buf.data[:topk+1]
-        v[topk:topk+1] = v_new
+            # shape: (s, b * n_head, head_dim)
+            indices_src = topk_indices
+            indices_tgt = (slice(0, indices_src.shape[0]), slice(0, v_home.shape[1]))
+            general_copy(v_buf, indices_tgt, v_home, indices_src)
+            v_home.device.synchronize()
+
+            # shape: (topk+1, b * n_head, head_dim)
+            v = v_buf.data[:topk+1]
+            v[topk:topk+1] = v_new
         # shape: (b * n_head, topk+1, head_dim)
         v = v.permute(1, 0, 2).reshape(b * n_head, topk+1, head_dim)
 
         # shape: (b * n_head, 1, head_dim)
         return torch.bmm(attn_weights, v).view(b, n_head, tgt_s, head_dim)
 
+    def _pinned_buffer(self, name, shape, dtype):
+        """Return a pinned cpu tensor of `shape`, reusing the buffer kept under `name`."""
+        numel = reduce(operator.mul, shape, 1)
+        buf = self._pinned_bufs.get(name)
+        if buf is None or buf.dtype != dtype or buf.numel() < numel:
+            buf = torch.empty((numel,), dtype=dtype, pin_memory=True)
+            self._pinned_bufs[name] = buf
+        return buf[:numel].view(shape)
+
     def _mixed_device_attention(self, q, k_cache, v_cache, k_new, v_new,
             mask, b, src_s, tgt_s, n_head, head_dim):
         # The caches are stored on both gpu and cpu.
@@ -556,6 +903,22 @@ class TorchDevice:
         v_gpu, v_cpu = v_cache[0].data, v_cache[1].data
         seg = k_gpu.shape[1]
 
+        # Stage the inputs of the CPU part through pinned buffers on a
+        # separate stream, so the CPU part only waits for these copies
+        # instead of the GPU part launched below.
+        if self._mixed_copy_stream is None:
+            self._mixed_copy_stream = torch.cuda.Stream()
+        copy_stream = self._mixed_copy_stream
+        copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(copy_stream):
+            q_stage = self._pinned_buffer("q", q[seg:].shape, q.dtype)
+            k_stage = self._pinned_buffer("k_new", k_new[:, seg:].shape, k_new.dtype)
+            v_stage = self._pinned_buffer("v_new", v_new[:, seg:].shape, v_new.dtype)
+            q_stage.copy_(q[seg:], non_blocking=True)
+            k_stage.copy_(k_new[:, seg:], non_blocking=True)
+            v_stage.copy_(v_new[:, seg:], non_blocking=True)
+            staged = copy_stream.record_event()
+
         # Compute GPU part
         b_gpu = seg // n_head
         q_gpu = q[:seg]
@@ -574,13 +937,14 @@ class TorchDevice:
             b_gpu, src_s, tgt_s, n_head, head_dim)
 
         # Compute CPU Part
+        staged.synchronize()
         b_cpu = b - b_gpu
-        q_cpu = q[seg:].float().cpu()
+        q_cpu = q_stage.to(k_cpu.dtype)
         # shape: (s, b * n_head, head_dim)
         k_cpu = k_cpu[:src_s, seg:, :]
         v_cpu = v_cpu[:src_s, seg:, :]
-        k_cpu[src_s-1:src_s, :, :] = k_new[:, seg:, :]
-        v_cpu[src_s-1:src_s, :, :] = v_new[:, seg:, :]
+        k_cpu[src_s-1:src_s, :, :] = k_stage
+        v_cpu[src_s-1:src_s, :, :] = v_stage
         # shape: (b * n_head, head_dim, s)
         k_cpu = k_cpu.permute(1, 2, 0)
         # shape: (b * n_head, s, head_dim)
@@ -590,26 +954,70 @@ class TorchDevice:
         value_cpu = self._attention_value(q_cpu, k_cpu, v_cpu, mask_cpu,
             b_cpu, src_s, tgt_s, n_head, head_dim)
 
-        value = torch.cat([value_gpu, value_cpu.cuda().half()], dim=0)
+        # Send the CPU result back on the copy stream and join the streams
+        value_stage = self._pinned_buffer("value", value_cpu.shape, value_gpu.dtype)
+        value_stage.copy_(value_cpu)
+        value_cpu = torch.empty_like(value_stage, device=self.dev)
+        with torch.cuda.stream(copy_stream):
+            value_cpu.copy_(value_stage, non_blocking=True)
+        torch.cuda.current_stream().wait_stream(copy_stream)
+
+        value = torch.cat([value_gpu, value_cpu], dim=0)
         return value
 
     def mlp(self, inputs, wi, bi, wo, bo, w_ln, b_ln, donate):
+        if (wi.device.device_type == DeviceType.COMPRESSED and
+                wi.data[2].num_bits == 8):
+            return self.mlp_int8(inputs, wi, bi, wo, bo, w_ln, b_ln, donate)
+
         # decompress weights
         if wi.device.device_type == DeviceType.COMPRESSED:
-            wi = wi.device.decompress(wi)
-            wo = wo.device.decompress(wo)
+            wi = self._cached_decompress(wi, donate[1])
+            wo = self._cached_decompress(wo, donate[3])
+
+        b, s, h = inputs.shape
+        x = inputs.data.view(b * s, h)
+
+        out = None
+        if self.compile_mlp:
+            # The compiled graph plans its own intermediate buffers
+            try:
+                out = self.mlp_body(x, wi.data, bi.data, wo.data, bo.data,
+                                    w_ln.data, b_ln.data)
+            except torch._dynamo.exc.TorchDynamoException as e:
+                # e.g. no working Triton or C++ compiler for inductor
+                warnings.warn(f"torch.compile of the mlp failed, running it eagerly: {e}")
+                self.compile_mlp = False
+        if out is None:
+            # Eager mode: --compile-mlp false, no torch.compile or a failed compile
+            out = mlp_body(x, wi.data, bi.data, wo.data, bo.data,
+                           w_ln.data, b_ln.data)
+        out = out.view(b, s, h)
+
+        if donate[0]: inputs.delete()
+        return TorchTensor.create_from_torch(out, self)
 
+    def mlp_int8(self, inputs, wi, bi, wo, bo, w_ln, b_ln, donate):
+        # wi and wo are per-channel int8 weights on the compressed device
         b, s, h = inputs.shape
+        x = inputs.data.view(b * s, h)
 
-        out = F.layer_norm(inputs.data, (h,), weight=w_ln.data, bias=b_ln.data)
-        out = F.linear(out, wi.data, bias=bi.data)
-        F.relu(out, inplace=True)
-        out = F.linear(out, wo.data, bias=bo.data)
+        out = F.layer_norm(x, (h,), weight=w_ln.data, bias=b_ln.data)
+        out = F.relu(self._int8_linear(out, wi, bi, donate[1]))
+        out = self._int8_linear(out, wo, bo, donate[3])
+        out = out.add_(x).view(b, s, h)
 
-        out.add_(inputs.data)
         if donate[0]: inputs.delete()
         return TorchTensor.create_from_torch(out, self)
 
+    def _int8_linear(self, inputs, w, b, donated):
+        """int8_linear, or F.linear with a cached dequantized weight for the
+        shapes (e.g. decoding with few rows) torch._int_mm does not take."""
+        if int8_mm_supported(inputs, w.shape[0]):
+            return int8_linear(inputs, w.data[0].data, w.data[1].data, b.data)
+        weight = self._cached_decompress(w, donated).to(inputs.dtype)
+        return F.linear(inputs, weight, bias=b.data)
+
     def synchronize(self):
         torch.cuda.synchronize()
 
@@ -648,7 +1056,8 @@ class TorchDevice:
 class TorchDisk:
     """Manage tensors stored on a disk."""
 
-    def __init__(self, path, mem_capacity=None, cuda_id=0, num_copy_threads=4):
+    def __init__(self, path, mem_capacity=None, cuda_id=0, num_copy_threads=4,
+                 pinned_pool_bytes=1 * GB):
         self.name = path
         self.path = os.path.abspath(os.path.expanduser(path))
         self.mem_capacity = mem_capacity
@@ -662,13 +1071,21 @@ class TorchDisk:
             os.makedirs(self.path)
 
         self.links = {}
+        # path -> (mmap, flat cpu tensor mapping the file), in LRU order. Each
+        # mmap holds a file descriptor, so only the recently used files stay
+        # mapped to keep a large disk KV cache under the descriptor limit.
+        self.mmap_cache = OrderedDict()
+        self.mmap_cache_size = 256
+        self.mmap_lock = threading.Lock()  # the copy threads share the cache
 
         # Copy threads
-        self.copy_queue = queue.Queue()  # queue中装了所有数据迁移任务 (python的queue是支持多线程的!! 有内部lock的)
+        self.pinned_pool = BufferPool(pinned_pool_bytes, pin_memory=True)  # copy threads共享的pinned relay buffer
+        self.copy_queue = CopyDispatcher(num_copy_threads)  # 每个copy thread一个任务deque, 空闲时可以从别的deque偷任务
         self.copy_threads = [  # 启多个工作线程跑copy_worker_func函数
             threading.Thread(
-                target=copy_worker_func, args=(self.copy_queue, cuda_id)
-            ) for _ in range(num_copy_threads)
+                target=copy_worker_func,
+                args=(self.copy_queue, cuda_id, self.pinned_pool, i)
+            ) for i in range(num_copy_threads)
         ]
         for t in self.copy_threads:
             t.start()
@@ -683,14 +1100,133 @@ class TorchDisk:
     def allocate(self, shape, dtype, pin_memory=None, name=None):
         name = name or TorchTensor.next_name()
         path = os.path.join(self.path, name)
-        np.lib.format.open_memmap(path, mode="w+", shape=shape, dtype=dtype)  # 创建内存映射, 但在这里有点多余?
+        # The file holds the raw data without a header. Extend it to its full
+        # size, it stays a sparse hole until it is written, and no memory map
+        # is created at allocation time.
+        shape = tuple(int(x) for x in shape)
+        with open(path, "wb") as fout:
+            fout.truncate(int(np.prod(shape)) * np.dtype(dtype).itemsize)
         return TorchTensor(shape, np_dtype_to_torch_dtype[dtype],
                            path, self, name=name)  # disk上的tensor其实就是一个文件, 这里直接用路径名作为tensor.data
 
     def delete(self, tensor):
+        with self.mmap_lock:
+            self.mmap_cache.pop(tensor.data, None)
         if os.path.exists(tensor.data) and tensor.delete_file:
             os.remove(tensor.data)
 
+    def map(self, tensor):
+        """Return a cpu tensor that shares memory with the file of a disk tensor.
+
+        The file is mapped on first access and the mapping is reused by later
+        copies. The kernel is told the access is sequential, which enlarges
+        readahead for streaming KV cache reads.
+        """
+        return self._mapping(tensor)[1].view(tensor.shape)
+
+    def _mapping(self, tensor):
+        """Return the (mmap, flat cpu tensor) of the file of a disk tensor.
+
+        An evicted mapping is unmapped, and its descriptor closed, once the
+        tensors of copies still using it are gone.
+        """
+        numel = reduce(operator.mul, tensor.shape, 1)
+        if numel == 0:
+            return None, torch.empty((0,), dtype=tensor.dtype)
+        with self.mmap_lock:
+            entry = self.mmap_cache.pop(tensor.data, None)
+        if entry is None or entry[1].numel() != numel or entry[1].dtype != tensor.dtype:
+            nbytes = numel * torch_dtype_to_num_bytes[tensor.dtype]
+            with open(tensor.data, "r+b") as fin:
+                buf = mmap.mmap(fin.fileno(), nbytes)
+            buf.madvise(mmap.MADV_SEQUENTIAL)
+            # Shared mapping, so writes reach the file
+            entry = (buf, torch.frombuffer(buf, dtype=tensor.dtype, count=numel))
+        with self.mmap_lock:
+            self.mmap_cache[tensor.data] = entry
+            while len(self.mmap_cache) > self.mmap_cache_size:
+                self.mmap_cache.popitem(last=False)
+        return entry
+
+    def prefetch(self, tensor, indices):
+        """Ask the kernel to read the pages spanned by a slice of a disk
+        tensor in the background, so a strided copy from the mapping does
+        not fault them in one by one."""
+        if (torch.is_tensor(indices) or not indices or
+                any(x.stop <= x.start for x in indices)):
+            return
+        buf, _ = self._mapping(tensor)
+        if buf is None:
+            return
+        shape = tensor.shape
+        first = last = 0
+        for i, n in enumerate(shape):
+            x = indices[i] if i < len(indices) else slice(0, n)
+            first, last = first * n + x.start, last * n + x.stop - 1
+        itemsize = torch_dtype_to_num_bytes[tensor.dtype]
+        start = first * itemsize // mmap.PAGESIZE * mmap.PAGESIZE
+        buf.madvise(mmap.MADV_WILLNEED, start, (last + 1) * itemsize - start)
+
+    @staticmethod
+    def file_range(tensor, indices):
+        """Return the (offset, nbytes) of a slice of a disk tensor in its file,
+        or None if the slice is not contiguous there."""
+        if torch.is_tensor(indices):
+            return None
+        shape, indices = tensor.shape, tuple(indices or ())
+        starts = [x.start for x in indices] + [0] * (len(shape) - len(indices))
+        sizes = [x.stop - x.start for x in indices] + list(shape[len(indices):])
+        # Row-major: contiguous iff all dims after the first one with more
+        # than one element are taken in full
+        k = next((i for i, n in enumerate(sizes) if n != 1), len(sizes))
+        if any(sizes[i] != shape[i] for i in range(k + 1, len(shape))):
+            return None
+        offset = 0
+        for start, n in zip(starts, shape):
+            offset = offset * n + start
+        itemsize = torch_dtype_to_num_bytes[tensor.dtype]
+        return offset * itemsize, reduce(operator.mul, sizes, 1) * itemsize
+
+    def _positional_io(self, tensor, indices, buf, write):
+        # Raw bytes are moved, so the buffer must match the file exactly.
+        # Otherwise the caller copies through the mapping, which converts.
+        rng = self.file_range(tensor, indices)
+        if (rng is None or buf.dtype != tensor.dtype or
+                not buf.is_contiguous() or buf.device.type != "cpu"):
+            return False
+        offset, nbytes = rng
+        view = buf.view(-1).view(torch.uint8).numpy()
+        if view.nbytes != nbytes:
+            return False
+        # Opened per call, so no descriptor is held between copies
+        fd = os.open(tensor.data, os.O_RDWR)
+        try:
+            io = os.pwritev if write else os.preadv
+            done = 0
+            while done < nbytes:
+                n = io(fd, [view[done:]], offset + done)
+                if n <= 0:
+                    return False  # the caller redoes the whole copy via the mapping
+                done += n
+        finally:
+            os.close(fd)
+        return True
+
+    def read_into(self, tensor, indices, buf):
+        """Read a slice of a disk tensor into a contiguous cpu tensor with
+        preadv, so large slices are read with a few big requests instead of
+        page faults on the memory map. Return False if it cannot, after
+        prefetching the slice for the copy from the mapping."""
+        if self._positional_io(tensor, indices, buf, write=False):
+            return True
+        self.prefetch(tensor, indices)
+        return False
+
+    def write_from(self, tensor, indices, buf):
+        """Write a contiguous cpu tensor to a slice of a disk tensor with
+        pwritev. Return False if it cannot."""
+        return self._positional_io(tensor, indices, buf, write=True)
+
     def init_cache_one_gpu_batch(self, config, task, policy):
         num_head, hidden_size, prompt_len, gen_len, gpu_batch_size = (
             config.n_head, config.input_dim, task.prompt_len, task.gen_len,
@@ -725,6 +1261,138 @@ class TorchDisk:
             self.close_copy_threads()
 
 
+class BufferPool:
+    """A pool of reusable byte buffers, e.g. pinned relay buffers shared by
+    the copy threads or scratch space of a compute device.
+
+    Buffers are uint8 tensors keyed by a size bucket, so a buffer is
+    allocated once and reused by later requests of similar size, e.g. a KV
+    cache slice that grows by one token per step. Buckets are multiples of
+    a cache line for small sizes and of 1/16 of the size's power of two
+    otherwise, wasting at most ~6%. Idle buffers beyond `max_bytes` are
+    freed, least recently used bucket first.
+    """
+
+    def __init__(self, max_bytes, device="cpu", pin_memory=False):
+        self.max_bytes = max_bytes
+        self.device = device
+        self.pin_memory = pin_memory
+        self.free_bufs = OrderedDict()  # nbytes -> list of idle buffers
+        self.free_bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def bucket_size(nbytes):
+        granularity = max(64, 1 << max(int(nbytes).bit_length() - 5, 0))
+        return (nbytes + granularity - 1) // granularity * granularity
+
+    def acquire(self, nbytes):
+        """Return an idle buffer of at least `nbytes` bytes."""
+        nbytes = self.bucket_size(nbytes)
+        with self.lock:
+            bufs = self.free_bufs.get(nbytes)
+            if bufs:
+                self.free_bytes -= nbytes
+                buf = bufs.pop()
+                if not bufs:
+                    del self.free_bufs[nbytes]
+                return buf
+        return torch.empty((nbytes,), dtype=torch.uint8, device=self.device,
+                           pin_memory=self.pin_memory)
+
+    def release(self, buf):
+        nbytes = buf.numel()
+        with self.lock:
+            self.free_bufs.setdefault(nbytes, []).append(buf)
+            self.free_bufs.move_to_end(nbytes)
+            self.free_bytes += nbytes
+            while self.free_bytes > self.max_bytes:
+                lru_nbytes, bufs = next(iter(self.free_bufs.items()))
+                bufs.pop()
+                if not bufs:
+                    del self.free_bufs[lru_nbytes]
+                self.free_bytes -= lru_nbytes
+
+    @contextlib.contextmanager
+    def borrow(self, nbytes):
+        buf = self.acquire(nbytes)
+        try:
+            yield buf[:nbytes]
+        finally:
+            self.release(buf)
+
+    @contextlib.contextmanager
+    def borrow_tensor(self, shape, dtype):
+        """Borrow a buffer viewed as a tensor of `shape` and `dtype`."""
+        nbytes = reduce(operator.mul, shape, 1) * torch_dtype_to_num_bytes[dtype]
+        with self.borrow(nbytes) as buf:
+            yield buf.view(dtype).view(shape)
+
+
+class CopyDispatcher:
+    """Dispatch copy tasks to the copy threads of a TorchDisk.
+
+    Each worker has its own deque and pops from it without taking a lock.
+    An idle worker steals from the other end of a sibling's deque. Tasks
+    are submitted round-robin. put_nowait/join follow queue.Queue, and
+    workers call get(worker_id) and task_done(worker_id).
+
+    Completed tasks are counted per worker, so task_done takes no lock.
+    join waits on an event that the worker finishing the last task sets.
+    """
+
+    def __init__(self, num_workers):
+        self.deques = [deque() for _ in range(num_workers)]
+        self.next_worker = 0
+        self.num_tasks = 0
+        self.num_done = [0] * num_workers  # each entry is written by one worker
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.all_tasks_done = threading.Event()
+
+    def put_nowait(self, item):
+        with self.mutex:
+            self.deques[self.next_worker].append(item)
+            self.next_worker = (self.next_worker + 1) % len(self.deques)
+            self.num_tasks += 1
+            self.not_empty.notify()
+
+    def _try_get(self, worker_id):
+        try:
+            return True, self.deques[worker_id].popleft()
+        except IndexError:
+            pass
+        for i in range(1, len(self.deques)):
+            try:
+                return True, self.deques[(worker_id + i) % len(self.deques)].pop()
+            except IndexError:
+                pass
+        return False, None
+
+    def get(self, worker_id):
+        while True:
+            found, item = self._try_get(worker_id)
+            if found:
+                return item
+            with self.mutex:
+                if not any(self.deques):
+                    self.not_empty.wait()
+
+    def task_done(self, worker_id):
+        self.num_done[worker_id] += 1
+        if sum(self.num_done) == self.num_tasks:
+            self.all_tasks_done.set()
+
+    def join(self):
+        while True:
+            # Clear before checking, so a set by the last task_done after
+            # the check is not lost
+            self.all_tasks_done.clear()
+            if sum(self.num_done) == self.num_tasks:
+                return
+            self.all_tasks_done.wait()
+
+
 # Segment dimension for tensors stored on TorchMixedDevice
 SEG_DIM = 1
 
@@ -736,7 +1404,10 @@ class TorchMixedDevice:
         self.device_type = DeviceType.MIXED
         self.base_devices = base_devices
 
-    def allocate(self, shape, dtype, seg_lengths, pin_memory=None, name=None):
+    def allocate(self, shape, dtype, seg_lengths, pin_memory=None, name=None,
+                 disk_comp_config=None):
+        """Allocate a tensor split along SEG_DIM. If `disk_comp_config` is
+        given, the disk segment is stored compressed with it."""
         assert sum(seg_lengths) == shape[SEG_DIM]
         assert len(seg_lengths) == len(self.base_devices)
         seg_points = [0]
@@ -751,14 +1422,22 @@ class TorchMixedDevice:
                 tensors.append(None)
             else:
                 seg_shape = shape[:SEG_DIM] + (seg_len,) + shape[SEG_DIM+1:]
-                tensors.append(devices[i].allocate(seg_shape, dtype,
-                    pin_memory=pin_memory))
+                if (disk_comp_config is not None and
+                        devices[i].device_type == DeviceType.DISK):
+                    tensors.append(devices[i].compressed_device.allocate(
+                        seg_shape, dtype, disk_comp_config))
+                else:
+                    tensors.append(devices[i].allocate(seg_shape, dtype,
+                        pin_memory=pin_memory))
 
-        return TorchTensor(shape, np_dtype_to_torch_dtype[dtype],
-                           (tensors, seg_points), self, name=name)
+        ret = TorchTensor(shape, np_dtype_to_torch_dtype[dtype],
+                          (tensors, seg_points), self, name=name)
+        # Indices of the non-empty segments, so copies skip the others
+        ret.active_indices = tuple(i for i, x in enumerate(tensors) if x is not None)
+        return ret
 
     def delete(self, tensor):
-        for x in self.tensor.data[0]:
+        for x in tensor.data[0]:
             if x:
                 x.delete()
 
@@ -779,11 +1458,15 @@ class TorchMixedDevice:
             len_disk = shape[SEG_DIM] - len_gpu - len_cpu
         lens = [len_gpu, len_cpu, len_disk]
 
-        pin_memory = False
-        k_cache = self.allocate(shape, np.float16,
-            seg_lengths=lens, pin_memory=pin_memory)
-        v_cache = self.allocate(shape, np.float16,
-            seg_lengths=lens, pin_memory=pin_memory)
+        # Pin the cpu segment if it is copied to the gpu every step
+        pin_memory = not policy.cpu_cache_compute
+        # Quantize the disk segment with one scale per token and head
+        disk_comp_config = (CompressionConfig(num_bits=8, group_size=shape[2],
+            group_dim=2, symmetric=True) if policy.int8_disk_cache else None)
+        k_cache = self.allocate(shape, np.float16, seg_lengths=lens,
+            pin_memory=pin_memory, disk_comp_config=disk_comp_config)
+        v_cache = self.allocate(shape, np.float16, seg_lengths=lens,
+            pin_memory=pin_memory, disk_comp_config=disk_comp_config)
         return k_cache, v_cache
 
 
@@ -823,76 +1506,95 @@ def general_copy(dst: TorchTensor, dst_indices: Tuple[slice],
     >>> env.disk.synchronize()
     >>> torch.cuda.synchronize()
     """
-    if dst.device.device_type == DeviceType.MIXED:  # MIXED: data: (tensors, segment_points); type: Tuple[Tuple[TorchTensor], Tuple[int]]
-        # The tensor is on mixed devices, do recursive calls
-        assert src.device.device_type != DeviceType.MIXED
-        seg_points = dst.data[1]
-
-        for i in range(len(dst.device.base_devices)):  # seg_points元组的每个下标对应一个设备, 分别是gpu,cpu,disk
-            if seg_points[i] == seg_points[i+1]:  # (seg_points[i], seg_points[i+1])是设备i对应的张量切片
-                continue
-            src_indices = src_indices or tuple(slice(0, x) for x in src.shape)
-            dst_indices = dst_indices or tuple(slice(0, x) for x in dst.shape)  # slices是个元组，每个元素对应shape中每一维的slice
-            tmp_src_indices = cut_indices(src_indices, seg_points[i], seg_points[i+1])  # 切出对应独立设备上的张量indices
-            tmp_dst_indices = cut_indices(dst_indices, seg_points[i], seg_points[i+1],
-                base=seg_points[i])  # dst张量在该维上从下标0放起, 因为要存成mixed_device的表示, 各设备的tensor是分开的, 即(tensors, segment_points)
-            general_copy(dst.data[0][i], tmp_dst_indices, src, tmp_src_indices)  # 递归调用处理每个设备上的张量copy
-    elif src.device.device_type == DeviceType.MIXED:
-        # The tensor is on mixed devices, do recursive calls
-        assert dst.device.device_type != DeviceType.MIXED
-        seg_points = src.data[1]
-
-        for i in range(len(src.device.base_devices)):
-            if seg_points[i] == seg_points[i+1]:
-                continue
-            src_indices = src_indices or tuple(slice(0, x) for x in src.shape)
-            dst_indices = dst_indices or tuple(slice(0, x) for x in dst.shape)
-            tmp_src_indices = cut_indices(src_indices, seg_points[i], seg_points[i+1],
-                base=seg_points[i])  # 现在轮到src张量从下标0读起，因为src才是mixed_device的表示, 各设备的tensor是分开的, 即(tensors, segment_points)
-            tmp_dst_indices = cut_indices(dst_indices, seg_points[i], seg_points[i+1])
-            general_copy(dst, tmp_dst_indices, src.data[0][i], tmp_src_indices)
+    if (dst.device.device_type == DeviceType.MIXED or
+            src.device.device_type == DeviceType.MIXED):
+        # The tensor is on mixed devices, copy each segment separately
+        for args in mixed_copy_segments(dst, dst_indices, src, src_indices):
+            general_copy(*args)
     elif (src.device.device_type == DeviceType.COMPRESSED or
           dst.device.device_type == DeviceType.COMPRESSED):
-        # The tensor is compressed, do recursive calls
-        general_copy_compressed(dst, dst_indices, src, src_indices)  # TODO: compress相关
+        if (src.device.device_type == DeviceType.COMPRESSED and
+                dst.device.device_type == DeviceType.COMPRESSED):
+            # The tensor is compressed, do recursive calls
+            general_copy_compressed(dst, dst_indices, src, src_indices)  # TODO: compress相关
+        else:
+            # An int8 disk segment of a KV cache. The copy threads quantize
+            # or dequantize it on the other tensor's device.
+            comp = src if src.device.device_type == DeviceType.COMPRESSED else dst
+            assert comp.device.base_device.device_type == DeviceType.DISK
+            comp.device.base_device.submit_copy(dst, dst_indices, src, src_indices)
     elif src.device.device_type == DeviceType.DISK:
         # The tensor is on the disk, dispatch to copy threads for asynchronous copy
         src.device.submit_copy(dst, dst_indices, src, src_indices)  # 放到工作队列queue中，由工作线程来异步处理
     elif dst.device.device_type == DeviceType.DISK:
         # The tensor is on the disk, dispatch to copy threads for asynchronous copy
         dst.device.submit_copy(dst, dst_indices, src, src_indices)  # 放到工作队列queue中，由工作线程来异步处理
-    elif (src.device.device_type == DeviceType.CUDA and
-          dst.device.device_type == DeviceType.CPU and   # gpu => cpu (如果不是pin memory): 同样放到工作队列queue中，由工作线程来异步处理 (工作线程是全局的, 并不是disk专享的)
-          not dst.data.is_pinned() and src.shape[0] > 1):  # TODO: src.shape[0] > 1存疑?
-        # The cpu tensor is not pinned, dispatch to copy threads and use pin_memory
-        # as a relay
-        global_disk_device.submit_copy(dst, dst_indices, src, src_indices)
-    elif (src.device.device_type == DeviceType.CPU and
-          dst.device.device_type == DeviceType.CUDA and  # cpu => gpu (如果不是pin memory): 把该src tensor的cpu memory给pin住
-          not src.data.is_pinned()):
-        # The cpu tensor is not pinned, use pin_memory as a relay
-        src = src.data[src_indices] if src_indices else src.data
-        dst = dst.data[dst_indices] if dst_indices else dst.data
-        src = src.pin_memory()  # 这是pytorch的接口
-        dst.copy_(src, non_blocking=True)
     else:  # 其余情形直接用pytorch接口复制即可
-        # The normal path
+        # The normal path. KV caches copied to the gpu are allocated pinned.
+        # Other unpinned cpu tensors are staged by the CUDA driver, which is
+        # cheaper than pinning a temporary copy or relaying through the copy
+        # threads.
         src = src.data[src_indices] if src_indices else src.data
         dst = dst.data[dst_indices] if dst_indices else dst.data
+        if src.is_cuda and not dst.is_cuda:
+            # A gpu->cpu copy may run on a side stream (e.g. the KV cache
+            # write-back on the store stream). Keep the allocator from reusing
+            # the source memory before the copy on this stream is done.
+            src.record_stream(torch.cuda.current_stream())
         dst.copy_(src, non_blocking=True)
 
 
-def cut_indices(indices, start, stop, base=0):
-    assert all(x.step is None for x in indices)
-    seg = indices[SEG_DIM]  # 仅对第SEG_DIM=1维进行cut，这一维也是mixed_device上张量的划分维度
-    return (indices[:SEG_DIM] +
-            (slice(max(seg.start, start) - base, min(seg.stop, stop) - base),) +
-            indices[SEG_DIM + 1:])
+def mixed_copy_segments(dst: TorchTensor, dst_indices: Tuple[slice],
+                        src: TorchTensor, src_indices: Tuple[slice]):
+    """Split a copy from or to a mixed tensor into per-segment copies.
+
+    Segments that the indices do not touch are skipped. Disk segments come
+    first, so the copy threads start while the other segments are copied.
+    A gpu segment is a single copy kernel whose slice grows every decode
+    step, so there is nothing for a CUDA graph to batch or replay.
+    """
+    mixed_is_dst = dst.device.device_type == DeviceType.MIXED
+    mixed = dst if mixed_is_dst else src
+    assert (src if mixed_is_dst else dst).device.device_type != DeviceType.MIXED
+    src_indices = src_indices or src.full_indices
+    dst_indices = dst_indices or dst.full_indices
+    assert all(x.step is None for x in src_indices + dst_indices)
+    seg_points = mixed.data[1]
+
+    # Only the SEG_DIM slice differs between the segments, so split the
+    # indices around it once and reuse the other slices for every segment.
+    seg = (dst_indices if mixed_is_dst else src_indices)[SEG_DIM]
+    other_seg = (src_indices if mixed_is_dst else dst_indices)[SEG_DIM]
+    dst_head, dst_tail = dst_indices[:SEG_DIM], dst_indices[SEG_DIM + 1:]
+    src_head, src_tail = src_indices[:SEG_DIM], src_indices[SEG_DIM + 1:]
+
+    work = []
+    for i in mixed.active_indices:  # gpu, cpu, disk
+        tensor = mixed.data[0][i]
+        start, stop = seg_points[i], seg_points[i+1]
+        lo, hi = max(seg.start, start), min(seg.stop, stop)
+        if hi <= lo:
+            continue
+        # The segment tensor is indexed from 0, the other tensor is not
+        seg_piece = slice(lo - start, hi - start)
+        piece = slice(max(other_seg.start, start), min(other_seg.stop, stop))
+        if mixed_is_dst:
+            item = (tensor, dst_head + (seg_piece,) + dst_tail,
+                    src, src_head + (piece,) + src_tail)
+        else:
+            item = (dst, dst_head + (piece,) + dst_tail,
+                    tensor, src_head + (seg_piece,) + src_tail)
+        work.append(item)
+    def on_disk(tensor):
+        device = getattr(tensor.device, "base_device", tensor.device)
+        return device.device_type == DeviceType.DISK
+    work.sort(key=lambda x: not on_disk(x[0 if mixed_is_dst else 2]))
+    return work
 
 
 def map_to_torch_tensor(tensor, indices):
     if tensor.device.device_type == DeviceType.DISK:
-        data = torch.from_numpy(np.lib.format.open_memmap(tensor.data))
+        data = tensor.device.map(tensor)
     else:
         data = tensor.data
 
@@ -902,21 +1604,147 @@ def map_to_torch_tensor(tensor, indices):
     return data[indices] if indices else data  # indices是slice对象的数组, 每个slice对应shape的一维
 
 
-def copy_worker_func(queue, cuda_id):
-    """The copy worker thread."""
+def _relay_views(buf, tensors):
+    """Split a borrowed relay buffer into views shaped like `tensors`."""
+    views, offset = [], 0
+    for x in tensors:
+        nbytes = x.numel() * x.element_size()
+        views.append(buf[offset:offset + nbytes].view(x.dtype).view(x.shape))
+        offset += BufferPool.bucket_size(nbytes)  # keep the views aligned
+    return views
+
+
+def _relay_bytes(tensors):
+    return sum(BufferPool.bucket_size(x.numel() * x.element_size()) for x in tensors)
+
+
+def read_disk_parts(parts, device, pinned_pool, copy_stream):
+    """Read slices (tensor, indices) of disk tensors onto a TorchDevice.
+
+    Slices for the gpu are staged together through one pinned relay buffer
+    of the copy threads' pool.
+    """
+    srcs = [map_to_torch_tensor(x, indices) for x, indices in parts]
+    if device.device_type != DeviceType.CUDA:
+        return srcs
+
+    with pinned_pool.borrow(_relay_bytes(srcs)) as buf:
+        outs = []
+        for (x, indices), src, relay in zip(parts, srcs, _relay_views(buf, srcs)):
+            if not x.device.read_into(x, indices, relay):
+                relay.copy_(src)
+            out = torch.empty(src.shape, dtype=src.dtype, device=device.dev)
+            out.copy_(relay, non_blocking=True)
+            outs.append(out)
+        copy_stream.record_event().synchronize()
+    return outs
+
+
+def write_disk_parts(parts, values, pinned_pool, copy_stream):
+    """Write `values` to slices (tensor, indices) of disk tensors.
+
+    Values on the gpu are staged together through one pinned relay buffer
+    of the copy threads' pool.
+    """
+    def write(x, indices, value):
+        if not x.device.write_from(x, indices, value):
+            map_to_torch_tensor(x, indices).copy_(value)
+
+    values = [value.to(x.dtype) for (x, _), value in zip(parts, values)]
+    if not any(value.is_cuda for value in values):
+        for (x, indices), value in zip(parts, values):
+            write(x, indices, value)
+        return
+
+    with pinned_pool.borrow(_relay_bytes(values)) as buf:
+        relays = _relay_views(buf, values)
+        for relay, value in zip(relays, values):
+            relay.copy_(value, non_blocking=True)
+        copy_stream.record_event().synchronize()
+        for (x, indices), relay in zip(parts, relays):
+            write(x, indices, relay)
+
+
+def copy_quantized(dst, dst_indices, src, src_indices, pinned_pool, copy_stream):
+    """Copy between a compressed tensor on the disk and a TorchDevice tensor.
+
+    Only the int8 data and the scales cross the disk and PCIe links. The
+    fp16 values are (de)quantized on the device of the other tensor.
+    """
+    if src.device.device_type == DeviceType.COMPRESSED:
+        device = dst.device
+        data_indices, scale_indices = get_compressed_indices(src, src_indices, src.shape)
+        data, scale = read_disk_parts(
+            [(src.data[0], tuple(data_indices)), (src.data[1], tuple(scale_indices))],
+            device, pinned_pool, copy_stream)
+        if src_indices:
+            shape = tuple(x.stop - x.start for x in src_indices) + src.shape[len(src_indices):]
+        else:
+            shape = src.shape
+        tmp = TorchTensor(shape, src.dtype,
+            (TorchTensor.create_from_torch(data, device),
+             TorchTensor.create_from_torch(scale, device), src.data[2]),
+            device.compressed_device)
+        map_to_torch_tensor(dst, dst_indices).copy_(device.compressed_device.decompress(tmp))
+    else:
+        tmp = src.device.compressed_device.compress(
+            map_to_torch_tensor(src, src_indices), dst.data[2])
+        data_indices, scale_indices = get_compressed_indices(dst, dst_indices, dst.shape)
+        write_disk_parts(
+            [(dst.data[0], tuple(data_indices)), (dst.data[1], tuple(scale_indices))],
+            [tmp.data[0].data, tmp.data[1].data], pinned_pool, copy_stream)
+
+
+def gpu_local_cpus(cuda_id):
+    """Return the cpus on the NUMA node of a gpu that this process may use,
+    or None if unknown."""
+    try:
+        props = torch.cuda.get_device_properties(cuda_id)
+        bus_id = (f"{props.pci_domain_id:04x}:{props.pci_bus_id:02x}:"
+                  f"{props.pci_device_id:02x}.0")
+        with open(f"/sys/bus/pci/devices/{bus_id}/local_cpulist") as fin:
+            cpus = set()
+            for part in fin.read().strip().split(","):  # e.g. "0-15,32-47"
+                lo, _, hi = part.partition("-")
+                cpus.update(range(int(lo), int(hi or lo) + 1))
+    except (AttributeError, AssertionError, RuntimeError, OSError, ValueError):
+        return None
+    return (cpus & os.sched_getaffinity(0)) or None
+
+
+def copy_worker_func(queue, cuda_id, pinned_pool, worker_id):
+    """The copy worker thread.
+
+    Only copies that touch the disk reach these threads. Copies between a
+    gpu and a cpu tensor, pinned or not, are issued by general_copy directly.
+    """
     torch.cuda.set_device(cuda_id)
+    # Run next to the gpu. The relay buffers this thread allocates are
+    # first touched here, so they land on the gpu's NUMA node and DMA does
+    # not cross the socket interconnect.
+    cpus = gpu_local_cpus(cuda_id)
+    if cpus:
+        os.sched_setaffinity(0, cpus)
 
-    cpu_buf = torch.empty((1 * GB,), dtype=torch.float16, pin_memory=True)
     copy_stream = torch.cuda.Stream()
 
     with torch.cuda.stream(copy_stream):
         while True:
-            item = queue.get()  # get()会block直到有一个item是available的
+            item = queue.get(worker_id)  # get()会block直到有一个item是available的
             if item is None:
-                queue.task_done()
+                queue.task_done(worker_id)
                 return
 
             dst, dst_indices, src, src_indices = item
+            if (src.device.device_type == DeviceType.COMPRESSED or
+                    dst.device.device_type == DeviceType.COMPRESSED):
+                copy_quantized(dst, dst_indices, src, src_indices, pinned_pool, copy_stream)
+                other = dst if src.device.device_type == DeviceType.COMPRESSED else src
+                if other.device.device_type == DeviceType.CUDA:
+                    copy_stream.record_event().synchronize()
+                queue.task_done(worker_id)
+                continue
+
             # 将不同设备上的data[index]数据加载到内存 (disk上数据会通过内存映射文件来读取)
             src_data = map_to_torch_tensor(src, src_indices)
             dst_data = map_to_torch_tensor(dst, dst_indices)
@@ -924,12 +1752,28 @@ def copy_worker_func(queue, cuda_id):
             if (src.device.device_type == DeviceType.CUDA or
                 dst.device.device_type == DeviceType.CUDA):
                 # Use a pinned cpu buffer as a relay
-                size = np.prod(src_data.shape)  # 将src_data的所有维度相乘，得到数据大小
-                tmp_cpu_buf = cpu_buf[:size].view(src_data.shape)  # 从pin memory中分配空间，并调整为和src_data相同的形状
-                tmp_cpu_buf.copy_(src_data)  # 拷贝到cpu_buf (其实就是把pin cpu memory作为中间媒介, 加快传输)
-                dst_data.copy_(tmp_cpu_buf)  # 再拷贝到dst
+                # 从pin memory pool中借一块和src_data相同形状的空间
+                with pinned_pool.borrow_tensor(src_data.shape, src_data.dtype) as tmp_cpu_buf:
+                    # Both DMA copies are asynchronous on this worker's stream.
+                    # Wait for the event before the host reads the relay or
+                    # hands it back to the pool.
+                    if not (src.device.device_type == DeviceType.DISK and
+                            src.device.read_into(src, src_indices, tmp_cpu_buf)):
+                        tmp_cpu_buf.copy_(src_data, non_blocking=True)  # 拷贝到cpu_buf (其实就是把pin cpu memory作为中间媒介, 加快传输)
+                    if src.device.device_type == DeviceType.CUDA:
+                        copy_stream.record_event().synchronize()
+                    if not (dst.device.device_type == DeviceType.DISK and
+                            dst.device.write_from(dst, dst_indices, tmp_cpu_buf)):
+                        dst_data.copy_(tmp_cpu_buf, non_blocking=True)  # 再拷贝到dst
+                    if dst.device.device_type == DeviceType.CUDA:
+                        copy_stream.record_event().synchronize()
             else:
                 # torch.Tensor.copy_(默认non_blocking=False)是pytorch里的常用操作，就是对张量进行就地更新，可以跨cpu/gpu，形状必须相同
-                dst_data.copy_(src_data)  # 非GPU设备间(cpu, disk)直接拷贝
+                if src.device.device_type == DeviceType.DISK:
+                    done = src.device.read_into(src, src_indices, dst_data)
+                else:
+                    done = dst.device.write_from(dst, dst_indices, src_data)
+                if not done:
+                    dst_data.copy_(src_data)  # 非GPU设备间(cpu, disk)直接拷贝
 
-            queue.task_done()  # 与queue.get()对应，表示取出的任务已经处理完毕
+            queue.task_done(worker_id)  # 与queue.get()对应，表示取出的任务已经处理完毕
@@ -0,0 +1,70 @@
+"""Test the int8 group-wise quantization of TorchCompressedDevice on the cpu."""
+import unittest
+
+import numpy as np
+import torch
+
+from flexgen import pytorch_backend as pb
+from flexgen.compression import CompressionConfig
+
+pb.fix_recursive_import()
+
+
+class Int8CompressionTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.comp = pb.TorchDevice("cpu").compressed_device
+
+    def int8_config(self, group_size, group_dim):
+        return CompressionConfig(num_bits=8, group_size=group_size,
+                                 group_dim=group_dim, symmetric=True)
+
+    def test_round_trip(self):
+        # 40 columns in groups of 16, so the last group is padded
+        x = torch.randn(6, 40, 3).half()
+        c = self.comp.compress(x, self.int8_config(16, 1))
+        data, scale, _ = c.data
+        self.assertEqual(data.data.dtype, torch.int8)
+        self.assertEqual(scale.data.dtype, torch.float32)
+        self.assertEqual(tuple(scale.shape), (6, 3, 1, 3))
+
+        y = self.comp.decompress(c)
+        self.assertEqual(tuple(y.shape), tuple(x.shape))
+        # Rounding to the nearest step of absmax / 127, plus fp16 rounding
+        absmax = x.float().abs().max()
+        self.assertLessEqual((y.float() - x.float()).abs().max().item(),
+                             absmax.item() / 254 * 1.01 + 1e-3)
+
+    def test_zero_and_tiny_groups(self):
+        x = torch.tensor([[0.0, 0.0, 0.0, 0.0],
+                          [1e-6, -2e-6, 0.0, 5e-7],
+                          [1e-3, -5e-4, 2e-4, 0.0]]).half()
+        c = self.comp.compress(x, self.int8_config(4, 1))
+        y = self.comp.decompress(c).float()
+        self.assertTrue(torch.isfinite(c.data[1].data).all())
+        self.assertTrue(torch.isfinite(y).all())
+        self.assertTrue(torch.equal(y[0], torch.zeros(4)))
+        for row, ref in zip(y[1:], x[1:].float()):
+            self.assertLessEqual((row - ref).abs().max().item(),
+                                 ref.abs().max().item() / 127)
+
+    def test_allocate_int8_scale_dtype(self):
+        c = self.comp.allocate((4, 32), np.float16, self.int8_config(16, 1),
+                               pin_memory=False)
+        self.assertEqual(c.data[0].dtype, torch.int8)
+        self.assertEqual(c.data[1].dtype, torch.float32)
+
+    def test_slice_rows(self):
+        x = torch.randn(10, 24).half()
+        for group_size, group_dim in ((24, 1), (4, 0)):
+            c = self.comp.compress(x, self.int8_config(group_size, group_dim))
+            full = self.comp.decompress(c)
+            for num_rows in (1, 4, 7, 10):
+                part = self.comp.slice_rows(c, num_rows)
+                self.assertEqual(tuple(part.shape), (num_rows, 24))
+                self.assertTrue(torch.equal(self.comp.decompress(part),
+                                            full[:num_rows]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,237 @@
+"""Test the cpu and disk helpers of pytorch_backend without a gpu."""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+import torch
+
+from flexgen import pytorch_backend as pb
+from flexgen.compression import CompressionConfig
+
+pb.fix_recursive_import()
+
+
+def make_disk(test):
+    # No copy threads, they need a gpu. The tests call the copy helpers directly.
+    path = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, path, ignore_errors=True)
+    return pb.TorchDisk(path, num_copy_threads=0)
+
+
+class FileRangeTest(unittest.TestCase):
+    def setUp(self):
+        self.tensor = pb.TorchTensor((4, 3, 5), torch.float16, "unused", None)
+
+    def check(self, indices):
+        """Compare file_range with the elements the indices select."""
+        ids = np.arange(4 * 3 * 5).reshape(4, 3, 5)
+        selected = ids[tuple(indices)].ravel()
+        rng = pb.TorchDisk.file_range(self.tensor, indices)
+        contiguous = bool(np.all(np.diff(selected) == 1))
+        self.assertEqual(rng is not None, contiguous, indices)
+        if rng is not None:
+            self.assertEqual(rng, (selected[0] * 2, selected.size * 2))
+
+    def test_contiguous_and_strided(self):
+        for indices in [
+                (slice(0, 4),),
+                (slice(1, 3), slice(0, 3)),
+                (slice(1, 3), slice(0, 2)),
+                (slice(2, 3), slice(1, 3)),
+                (slice(2, 3), slice(1, 2), slice(1, 4)),
+                (slice(0, 2), slice(0, 3), slice(0, 4)),
+                (slice(3, 4), slice(0, 3), slice(0, 5))]:
+            self.check(indices)
+
+    def test_no_indices(self):
+        self.assertEqual(pb.TorchDisk.file_range(self.tensor, None), (0, 120))
+        self.assertIsNone(pb.TorchDisk.file_range(self.tensor, torch.tensor([0, 2])))
+
+
+class TorchDiskTest(unittest.TestCase):
+    def setUp(self):
+        self.disk = make_disk(self)
+
+    def test_read_into_write_from(self):
+        x = self.disk.allocate((4, 3, 5), np.float16)
+        src = torch.randn(4, 3, 5).half()
+        indices = (slice(1, 3),)
+        self.assertTrue(self.disk.write_from(x, indices, src[1:3].clone()))
+        out = torch.empty(2, 3, 5, dtype=torch.float16)
+        self.assertTrue(self.disk.read_into(x, indices, out))
+        self.assertTrue(torch.equal(out, src[1:3]))
+        self.assertTrue(torch.equal(self.disk.map(x)[1:3], src[1:3]))
+
+        # Strided slices and mismatched dtypes are left to the caller
+        strided = (slice(0, 4), slice(0, 2))
+        self.assertFalse(self.disk.read_into(x, strided, torch.empty(4, 2, 5).half()))
+        self.assertFalse(self.disk.write_from(x, indices, src[1:3].float()))
+
+    def test_mapping_cache_is_bounded(self):
+        self.disk.mmap_cache_size = 4
+        tensors = [self.disk.allocate((8,), np.float16) for _ in range(10)]
+        for i, x in enumerate(tensors):
+            self.disk.map(x)[:] = i
+        self.assertEqual(len(self.disk.mmap_cache), 4)
+        for i, x in enumerate(tensors):
+            self.assertTrue(torch.equal(self.disk.map(x), torch.full((8,), i).half()))
+        for x in tensors:
+            x.delete()
+        self.assertEqual(len(self.disk.mmap_cache), 0)
+        self.assertEqual(os.listdir(self.disk.path), [])
+
+
+class MixedCopySegmentsTest(unittest.TestCase):
+    def setUp(self):
+        self.cpu = pb.TorchDevice("cpu")
+        self.disk = make_disk(self)
+        self.mixed = pb.TorchMixedDevice([self.cpu, self.cpu, self.disk])
+
+    def test_split(self):
+        x = self.mixed.allocate((6, 8, 2), np.float16, seg_lengths=[2, 3, 3],
+                                pin_memory=False)
+        other = pb.TorchTensor.create_from_torch(torch.zeros(6, 8, 2).half(), self.cpu)
+        indices = (slice(0, 6), slice(1, 7))
+        work = pb.mixed_copy_segments(x, indices, other, indices)
+
+        # The disk segment comes first
+        self.assertIs(work[0][0], x.data[0][2])
+        segments = {id(dst): (dst_indices, src_indices)
+                    for dst, dst_indices, _, src_indices in work}
+        self.assertEqual(segments[id(x.data[0][0])],
+                         ((slice(0, 6), slice(1, 2)), (slice(0, 6), slice(1, 2))))
+        self.assertEqual(segments[id(x.data[0][1])],
+                         ((slice(0, 6), slice(0, 3)), (slice(0, 6), slice(2, 5))))
+        self.assertEqual(segments[id(x.data[0][2])],
+                         ((slice(0, 6), slice(0, 2)), (slice(0, 6), slice(5, 7))))
+
+    def test_skip_untouched_and_empty_segments(self):
+        x = self.mixed.allocate((6, 8, 2), np.float16, seg_lengths=[0, 5, 3],
+                                pin_memory=False)
+        self.assertEqual(x.active_indices, (1, 2))
+        other = pb.TorchTensor.create_from_torch(torch.zeros(6, 8, 2).half(), self.cpu)
+        indices = (slice(0, 6), slice(1, 4))
+        work = pb.mixed_copy_segments(other, indices, x, indices)
+        self.assertEqual(len(work), 1)
+        dst, dst_indices, src, src_indices = work[0]
+        self.assertIs(src, x.data[0][1])
+        self.assertEqual(src_indices, (slice(0, 6), slice(1, 4)))
+        self.assertEqual(dst_indices, indices)
+
+
+class BufferPoolTest(unittest.TestCase):
+    def test_bucket_size(self):
+        for nbytes in [1, 63, 64, 65, 1000, 4096, 12345, 1 << 20, (1 << 20) + 1]:
+            size = pb.BufferPool.bucket_size(nbytes)
+            self.assertGreaterEqual(size, nbytes)
+            self.assertEqual(size % 64, 0)
+            self.assertLessEqual(size, max(64, nbytes * 17 // 16 + 64))
+            self.assertEqual(pb.BufferPool.bucket_size(size), size)
+
+    def test_reuse_and_eviction(self):
+        pool = pb.BufferPool(max_bytes=2048)
+        buf = pool.acquire(1000)
+        ptr = buf.data_ptr()
+        pool.release(buf)
+        # Similar sizes share a bucket and get the same buffer back
+        with pool.borrow(990) as buf:
+            self.assertEqual(buf.data_ptr(), ptr)
+            self.assertEqual(buf.numel(), 990)
+
+        with pool.borrow_tensor((3, 4), torch.float16) as x:
+            self.assertEqual((tuple(x.shape), x.dtype), ((3, 4), torch.float16))
+
+        bufs = [pool.acquire(1024) for _ in range(4)]
+        for buf in bufs:
+            pool.release(buf)
+        self.assertLessEqual(pool.free_bytes, 2048)
+        self.assertEqual(pool.free_bytes, sum(
+            buf.numel() for bufs in pool.free_bufs.values() for buf in bufs))
+
+
+class CopyDispatcherTest(unittest.TestCase):
+    def run_workers(self, queue, num_workers, work):
+        def worker(worker_id):
+            while True:
+                item = queue.get(worker_id)
+                if item is not None:
+                    work(worker_id, item)
+                queue.task_done(worker_id)
+                if item is None:
+                    return
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in range(num_workers)]
+        for t in threads:
+            t.start()
+        return threads
+
+    def test_all_tasks_done(self):
+        queue = pb.CopyDispatcher(3)
+        done = []
+        lock = threading.Lock()
+        def work(worker_id, item):
+            with lock:
+                done.append(item)
+        threads = self.run_workers(queue, 3, work)
+        for i in range(5):
+            items = list(range(i * 100, i * 100 + 100))
+            for item in items:
+                queue.put_nowait(item)
+            queue.join()
+            self.assertEqual(sorted(done[-100:]), items)
+        for _ in threads:
+            queue.put_nowait(None)
+        for t in threads:
+            t.join()
+        queue.join()
+        self.assertEqual(len(done), 500)
+
+    def test_idle_worker_steals(self):
+        queue = pb.CopyDispatcher(2)
+        workers = []
+        def work(worker_id, item):
+            if worker_id == 0:
+                time.sleep(0.05)
+            workers.append((worker_id, item))
+        threads = self.run_workers(queue, 2, work)
+        # Round-robin puts every even item on the slow worker's deque
+        for item in range(8):
+            queue.put_nowait(item)
+        queue.join()
+        stolen = [item for worker_id, item in workers
+                  if worker_id == 1 and item % 2 == 0]
+        self.assertTrue(stolen)
+        for _ in threads:
+            queue.put_nowait(None)
+        for t in threads:
+            t.join()
+
+
+class CopyQuantizedTest(unittest.TestCase):
+    def test_round_trip(self):
+        cpu = pb.TorchDevice("cpu")
+        disk = make_disk(self)
+        # One scale per token and head, as for the disk segment of a KV cache
+        config = CompressionConfig(num_bits=8, group_size=16, group_dim=2,
+                                   symmetric=True)
+        x = disk.compressed_device.allocate((6, 4, 16), np.float16, config)
+        src = torch.randn(6, 4, 16).half()
+        src_tensor = pb.TorchTensor.create_from_torch(src, cpu)
+
+        indices = (slice(1, 5), slice(0, 4))
+        pb.copy_quantized(x, indices, src_tensor, indices, disk.pinned_pool, None)
+        dst = pb.TorchTensor.create_from_torch(torch.zeros(4, 4, 16).half(), cpu)
+        pb.copy_quantized(dst, None, x, indices, disk.pinned_pool, None)
+
+        ref = src[1:5].float()
+        step = ref.abs().amax(dim=2, keepdim=True) / 127
+        err = (dst.data.float() - ref).abs()
+        self.assertTrue(torch.all(err <= step / 2 + 1e-3))
+
+
+if __name__ == "__main__":
+    unittest.main()